@@ -0,0 +1,739 @@
+import argparse
+import csv
+from pathlib import Path
+
+# Amazon caps the size of an inventory file; at about 1KB a row, this keeps
+# each one to a few MB
+DEFAULT_MAX_ROWS = 5000
+
+# The rows Amazon's template starts with, above the field names
+TEMPLATE_ROWS = [
+    [
+        "TemplateType=fptcustom",
+        "Version=2020.0324",
+        "TemplateSignature=S0lUQ0hFTg==",
+        "The top 3 rows are for Amazon.com use only. Do not modify or delete the top 3 rows.",  # noqa:E501
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Images",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Variation",
+        "",
+        "",
+        "",
+        "Basic",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Discovery",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Product Enrichment",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Dimensions",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Fulfillment",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Compliance",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "Offer",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        "",
+        ""
+    ],
+    [
+        "Product Type",
+        "Seller SKU",
+        "Brand Name",
+        "Product Name",
+        "Product ID",
+        "Product ID Type",
+        "Item Type Keyword",
+        "Standard Price",
+        "Quantity",
+        "Main Image URL",
+        "Other Image URL1",
+        "Other Image URL2",
+        "Other Image URL3",
+        "Other Image URL4",
+        "Other Image URL5",
+        "Other Image URL6",
+        "Other Image URL7",
+        "Other Image URL8",
+        "Swatch Image URL",
+        "Parentage",
+        "Parent SKU",
+        "Relationship Type",
+        "Variation Theme",
+        "Update Delete",
+        "Product Description",
+        "Manufacturer",
+        "Manufacturer Part Number",
+        "model",
+        "closure_type",
+        "Key Product Features",
+        "Key Product Features",
+        "Key Product Features",
+        "Key Product Features",
+        "Key Product Features",
+        "Target Audience",
+        "Catalog Number",
+        "Used For1 - Used For3",
+        "Used For1 - Used For3",
+        "Used For1 - Used For3",
+        "Used For1 - Used For3",
+        "Used For1 - Used For3",
+        "Target Audience",
+        "Target Audience",
+        "Target Audience",
+        "Other Attributes",
+        "Other Attributes",
+        "Other Attributes",
+        "Other Attributes",
+        "Subject Matter",
+        "Subject Matter",
+        "Subject Matter",
+        "Search Terms",
+        "Platinum Keywords",
+        "Platinum Keywords",
+        "Platinum Keywords",
+        "Platinum Keywords",
+        "Platinum Keywords",
+        "Country/Region as Labeled",
+        "Fur Description",
+        "Occasion",
+        "Number of Pieces",
+        "Scent",
+        "Included Components",
+        "Color",
+        "Color Map",
+        "Size",
+        "Material Type",
+        "Style Name",
+        "Power Source",
+        "Wattage",
+        "Additional Features",
+        "Additional Features",
+        "Additional Features",
+        "Additional Features",
+        "Additional Features",
+        "Pattern",
+        "Lithium Battery Voltage",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Compatible Devices",
+        "Wattage Unit of Measure",
+        "included_features",
+        "Lithium Battery Voltage Unit of Measure",
+        "Length Range",
+        "shaft_style_type",
+        "Specification Met",
+        "breed_recommendation",
+        "directions",
+        "Number of Sets",
+        "Blade Type",
+        "Blade Material Type",
+        "Material Composition",
+        "Maximum Age Recommendation",
+        "Minimum Age Recommendation",
+        "Shipping Weight",
+        "Website Shipping Weight Unit Of Measure",
+        "Shape",
+        "Display Length Unit Of Measure",
+        "Item Display Width Unit Of Measure",
+        "Item Display Height Unit Of Measure",
+        "Item Display Length",
+        "Item Display Width",
+        "Item Display Depth",
+        "Item Display Height",
+        "Item Display Diameter",
+        "Item Display Weight",
+        "Item Display Weight Unit Of Measure",
+        "Volume",
+        "Volume Capacity Name Unit Of Measure",
+        "Item Height",
+        "Item Length",
+        "Item Width",
+        "Size Map",
+        "Weight Recommendation Unit Of Measure",
+        "Width Range",
+        "maximum_weight_recommendation",
+        "Item Dimensions Unit Of Measure",
+        "Fulfillment Center ID",
+        "Package Height",
+        "Package Width",
+        "Package Length",
+        "Package Dimensions Unit Of Measure",
+        "Package Weight",
+        "Package Weight Unit Of Measure",
+        "Energy Guide Label",
+        "Manufacturer Warranty Description",
+        "Cpsia Warning",
+        "CPSIA Warning Description",
+        "Fabric Type",
+        "Import Designation",
+        "Please provide the Executive Number (EO) required for sale into California.",  # noqa:E501
+        "Please provide the expiration date of the EO Number.",
+        "Volume",
+        "item_volume_unit_of_measure",
+        "Specific Uses For Product",
+        "Country/Region of Origin",
+        "Country/Region of Origin",
+        "Legal Disclaimer",
+        "USDA Hardiness Zone",
+        "USDA Hardiness Zone",
+        "Batteries are Included",
+        "Item Weight",
+        "Is this product a battery or does it utilize batteries?",
+        "Battery type/size",
+        "Battery type/size",
+        "Battery type/size",
+        "item_weight_unit_of_measure",
+        "Number of batteries",
+        "Number of batteries",
+        "Number of batteries",
+        "Watt hours per battery",
+        "Lithium Battery Packaging",
+        "Lithium content (grams)",
+        "Number of Lithium-ion Cells",
+        "Number of Lithium Metal Cells",
+        "Battery composition",
+        "Battery weight (grams)",
+        "battery_weight_unit_of_measure",
+        "lithium_battery_energy_content_unit_of_measure",
+        "lithium_battery_weight_unit_of_measure",
+        "Applicable Dangerous Goods Regulations",
+        "Applicable Dangerous Goods Regulations",
+        "Applicable Dangerous Goods Regulations",
+        "Applicable Dangerous Goods Regulations",
+        "Applicable Dangerous Goods Regulations",
+        "UN number",
+        "Safety Data Sheet (SDS) URL",
+        "Lighting Facts Label",
+        "Flash point (°C)?",
+        "external_testing_certification1",
+        "external_testing_certification2",
+        "external_testing_certification3",
+        "external_testing_certification4",
+        "external_testing_certification5",
+        "external_testing_certification6",
+        "Categorization/GHS pictograms (select all that apply)",
+        "Categorization/GHS pictograms (select all that apply)",
+        "Categorization/GHS pictograms (select all that apply)",
+        "California Proposition 65 Warning Type",
+        "California Proposition 65 Chemical Names",
+        "Additional Chemical Name1",
+        "Additional Chemical Name2",
+        "Additional Chemical Name3",
+        "Additional Chemical Name4",
+        "Shipping-Template",
+        "Manufacturer's Suggested Retail Price",
+        "Minimum Advertised Price",
+        "Launch Date",
+        "Release Date",
+        "Item Condition",
+        "Restock Date",
+        "Handling Time",
+        "Offer Condition Note",
+        "Product Tax Code",
+        "Sale Price",
+        "Sale Start Date",
+        "Sale End Date",
+        "Package Quantity",
+        "Max Aggregate Ship Quantity",
+        "Offering Can Be Gift Messaged",
+        "Is Gift Wrap Available",
+        "Is Discontinued by Manufacturer",
+        "Max Order Quantity",
+        "Number of Items",
+        "Offering Release Date",
+        "Stop Selling Date"
+    ]
+]
+
+# (field, value) for every column, in order.  The values are the same for
+# every mug and stored once; the None fields are filled in by `format_row`.
+COLUMNS = [
+    ("feed_product_type", "kitchen"),
+    ("item_sku", None),
+    ("brand_name", "Gifts On Demand"),
+    ("item_name", None),
+    ("external_product_id", ""),
+    ("external_product_id_type", "UPC"),
+    ("item_type", "novelty-coffee-mugs"),
+    ("standard_price", 19.95),
+    ("quantity", 99),
+    ("main-image-url", None),
+    ("other-image-url1", None),
+    ("other-image-url2", None),
+    ("other-image-url3", None),
+    ("other-image-url4", None),
+    ("other-image-url5", None),
+    ("other-image-url6", None),
+    ("other-image-url7", None),
+    ("other-image-url8", None),
+    ("swatch-image-url", ""),
+    ("parent_child", ""),
+    ("parent_sku", ""),
+    ("relationship_type", ""),
+    ("variation_theme", ""),
+    ("update_delete", ""),
+    ("product_description", ""),
+    ("manufacturer", ""),
+    ("part_number", ""),
+    ("model", ""),
+    ("closure_type", ""),
+    ("bullet_point1", "High quality mug makes the perfect gift for everyone."),
+    ("bullet_point2", "Printed on only the highest quality mugs. The print will never fade no matter how many times it is washed."),  # noqa:E501
+    ("bullet_point3", "Packaged, and shipped from the USA."),
+    ("bullet_point4", "Dishwasher and Microwave safe."),
+    ("bullet_point5", "Shipped in a custom made styrofoam package to ensure it arrives perfect. GUARANTEED."),  # noqa:E501
+    ("target_audience_base", ""),
+    ("catalog_number", ""),
+    ("specific_uses_keywords1", ""),
+    ("specific_uses_keywords2", ""),
+    ("specific_uses_keywords3", ""),
+    ("specific_uses_keywords4", ""),
+    ("specific_uses_keywords5", ""),
+    ("target_audience_keywords1", ""),
+    ("target_audience_keywords2", ""),
+    ("target_audience_keywords3", ""),
+    ("thesaurus_attribute_keywords1", ""),
+    ("thesaurus_attribute_keywords2", ""),
+    ("thesaurus_attribute_keywords3", ""),
+    ("thesaurus_attribute_keywords4", ""),
+    ("thesaurus_subject_keywords1", ""),
+    ("thesaurus_subject_keywords2", ""),
+    ("thesaurus_subject_keywords3", ""),
+    ("generic_keywords", None),
+    ("platinum_keywords1", ""),
+    ("platinum_keywords2", ""),
+    ("platinum_keywords3", ""),
+    ("platinum_keywords4", ""),
+    ("platinum_keywords5", ""),
+    ("country_as_labeled", ""),
+    ("fur_description", ""),
+    ("occasion", ""),
+    ("number_of_pieces", ""),
+    ("scent_name", ""),
+    ("included_components", ""),
+    ("color_name", "white"),
+    ("color_map", ""),
+    ("size_name", ""),
+    ("material_type", ""),
+    ("style_name", ""),
+    ("power_source_type", ""),
+    ("wattage", ""),
+    ("special_features1", ""),
+    ("special_features2", ""),
+    ("special_features3", ""),
+    ("special_features4", ""),
+    ("special_features5", ""),
+    ("pattern_name", ""),
+    ("lithium_battery_voltage", ""),
+    ("compatible_devices1", ""),
+    ("compatible_devices2", ""),
+    ("compatible_devices3", ""),
+    ("compatible_devices4", ""),
+    ("compatible_devices5", ""),
+    ("compatible_devices6", ""),
+    ("compatible_devices7", ""),
+    ("compatible_devices8", ""),
+    ("compatible_devices9", ""),
+    ("compatible_devices10", ""),
+    ("wattage_unit_of_measure", ""),
+    ("included_features", ""),
+    ("lithium_battery_voltage_unit_of_measure", ""),
+    ("length_range", ""),
+    ("shaft_style_type", ""),
+    ("specification_met", ""),
+    ("breed_recommendation", ""),
+    ("directions", ""),
+    ("number_of_sets", ""),
+    ("blade_edge_type", ""),
+    ("blade_material_type", ""),
+    ("material_composition", ""),
+    ("mfg_maximum", ""),
+    ("mfg_minimum", ""),
+    ("website_shipping_weight", ""),
+    ("website_shipping_weight_unit_of_measure", ""),
+    ("item_shape", ""),
+    ("item_display_length_unit_of_measure", ""),
+    ("item_display_width_unit_of_measure", ""),
+    ("item_display_height_unit_of_measure", ""),
+    ("item_display_length", ""),
+    ("item_display_width", ""),
+    ("item_display_depth", ""),
+    ("item_display_height", ""),
+    ("item_display_diameter", ""),
+    ("item_display_weight", ""),
+    ("item_display_weight_unit_of_measure", ""),
+    ("volume_capacity_name", 11),
+    ("volume_capacity_name_unit_of_measure", "ounces"),
+    ("item_height", ""),
+    ("item_length", ""),
+    ("item_width", ""),
+    ("size_map", ""),
+    ("weight_recommendation_unit_of_measure", ""),
+    ("width_range", ""),
+    ("maximum_weight_recommendation", ""),
+    ("item_dimensions_unit_of_measure", ""),
+    ("fulfillment_center_id", ""),
+    ("package_height", ""),
+    ("package_width", ""),
+    ("package_length", ""),
+    ("package_dimensions_unit_of_measure", ""),
+    ("package_weight", ""),
+    ("package_weight_unit_of_measure", ""),
+    ("energy_efficiency_image_url", ""),
+    ("warranty_description", ""),
+    ("cpsia_cautionary_statement", ""),
+    ("cpsia_cautionary_description", ""),
+    ("fabric_type", ""),
+    ("import_designation", ""),
+    ("legal_compliance_certification_metadata", ""),
+    ("legal_compliance_certification_expiration_date", ""),
+    ("item_volume", ""),
+    ("item_volume_unit_of_measure", ""),
+    ("specific_uses_for_product", ""),
+    ("country_string", ""),
+    ("country_of_origin", ""),
+    ("legal_disclaimer_description", ""),
+    ("usda_hardiness_zone1", ""),
+    ("usda_hardiness_zone2", ""),
+    ("are_batteries_included", ""),
+    ("item_weight", ""),
+    ("batteries_required", ""),
+    ("battery_type1", ""),
+    ("battery_type2", ""),
+    ("battery_type3", ""),
+    ("item_weight_unit_of_measure", ""),
+    ("number_of_batteries1", ""),
+    ("number_of_batteries2", ""),
+    ("number_of_batteries3", ""),
+    ("lithium_battery_energy_content", ""),
+    ("lithium_battery_packaging", ""),
+    ("lithium_battery_weight", ""),
+    ("number_of_lithium_ion_cells", ""),
+    ("number_of_lithium_metal_cells", ""),
+    ("battery_cell_composition", ""),
+    ("battery_weight", ""),
+    ("battery_weight_unit_of_measure", ""),
+    ("lithium_battery_energy_content_unit_of_measure", ""),
+    ("lithium_battery_weight_unit_of_measure", ""),
+    ("supplier_declared_dg_hz_regulation1", ""),
+    ("supplier_declared_dg_hz_regulation2", ""),
+    ("supplier_declared_dg_hz_regulation3", ""),
+    ("supplier_declared_dg_hz_regulation4", ""),
+    ("supplier_declared_dg_hz_regulation5", ""),
+    ("hazmat_united_nations_regulatory_id", ""),
+    ("safety_data_sheet_url", ""),
+    ("lighting_facts_image_url", ""),
+    ("flash_point", ""),
+    ("external_testing_certification1", ""),
+    ("external_testing_certification2", ""),
+    ("external_testing_certification3", ""),
+    ("external_testing_certification4", ""),
+    ("external_testing_certification5", ""),
+    ("external_testing_certification6", ""),
+    ("ghs_classification_class1", ""),
+    ("ghs_classification_class2", ""),
+    ("ghs_classification_class3", ""),
+    ("california_proposition_65_compliance_type", ""),
+    ("california_proposition_65_chemical_names1", ""),
+    ("california_proposition_65_chemical_names2", ""),
+    ("california_proposition_65_chemical_names3", ""),
+    ("california_proposition_65_chemical_names4", ""),
+    ("california_proposition_65_chemical_names5", ""),
+    ("merchant_shipping_group_name", ""),
+    ("list_price", ""),
+    ("map_price", ""),
+    ("product_site_launch_date", ""),
+    ("merchant_release_date", ""),
+    ("condition_type", ""),
+    ("restock_date", ""),
+    ("fulfillment_latency", ""),
+    ("condition_note", ""),
+    ("product_tax_code", ""),
+    ("sale_price", ""),
+    ("sale_from_date", ""),
+    ("sale_end_date", ""),
+    ("item_package_quantity", ""),
+    ("max_aggregate_ship_quantity", ""),
+    ("offering_can_be_gift_messaged", ""),
+    ("offering_can_be_giftwrapped", ""),
+    ("is_discontinued_by_manufacturer", ""),
+    ("max_order_quantity", ""),
+    ("number_of_items", ""),
+    ("offering_start_date", ""),
+    ("offering_end_date", ""),
+]
+
+FIELDS = [field for field, _ in COLUMNS]
+_FIELD_INDEX = {field: i for i, field in enumerate(FIELDS)}
+_STATIC_ROW = ["" if value is None else value for _, value in COLUMNS]
+
+
+def format_row(sku, item_name, keywords, image_urls):
+    # A copy of the static row with this mug's fields set.  The first image
+    # is the main one, the rest fill the other image columns.
+    row = list(_STATIC_ROW)
+    row[_FIELD_INDEX["item_sku"]] = sku
+    row[_FIELD_INDEX["item_name"]] = item_name
+    row[_FIELD_INDEX["generic_keywords"]] = keywords
+    row[_FIELD_INDEX["main-image-url"]] = image_urls[0]
+    for i, image_url in enumerate(image_urls[1:], 1):
+        row[_FIELD_INDEX[f"other-image-url{i}"]] = image_url
+    return row
+
+
+def parse_max_rows_arg(value):
+    try:
+        max_rows = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Not a number of rows: {value}")
+    if max_rows < 1:
+        raise argparse.ArgumentTypeError(
+            f"A listing file needs room for at least 1 row, got {max_rows}")
+    return max_rows
+
+
+def listing_file_path(path_stem, part):
+    # The first file is `path_stem`.txt, the ones after it are numbered
+    if part == 1:
+        return Path(f"{path_stem}.txt")
+    return Path(f"{path_stem}_{part}.txt")
+
+
+def free_path_stem(path_stem):
+    # `path_stem`, or `path_stem`-2, -3, ... when an earlier run, e.g. one
+    # that crashed and is being resumed, already wrote listing files there
+    stem = path_stem
+    run = 1
+    while listing_file_path(stem, 1).exists():
+        run += 1
+        stem = f"{path_stem}-{run}"
+    return stem
+
+
+def _open_listing_file(path):
+    # Never truncates: the rows of an earlier run are journaled as listed
+    output_file = open(path, "x", newline="")
+    writer = csv.writer(output_file, delimiter="\t")
+    writer.writerows(TEMPLATE_ROWS)
+    writer.writerow(FIELDS)
+    return output_file, writer
+
+
+def write_listing_files(rows, path_stem, max_rows=DEFAULT_MAX_ROWS):
+    # Writes `rows` of (row, tag) as they arrive, starting a new file after
+    # every `max_rows`.  Yields each tag once its row is on disk.  Without
+    # any rows it still writes one file, with just the header.  Files that
+    # already exist are left alone, see `free_path_stem`.
+    path_stem = free_path_stem(path_stem)
+    part = 1
+    part_rows = 0
+    output_file, writer = _open_listing_file(listing_file_path(path_stem, part))
+    try:
+        for row, tag in rows:
+            if part_rows == max_rows:
+                output_file.close()
+                part += 1
+                part_rows = 0
+                output_file, writer = _open_listing_file(
+                    listing_file_path(path_stem, part))
+            writer.writerow(row)
+            output_file.flush()
+            part_rows += 1
+            yield tag
+    finally:
+        output_file.close()
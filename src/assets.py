@@ -0,0 +1,188 @@
+from functools import lru_cache
+import json
+import mmap
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
+
+RESOURCES_PATH = Path(__file__).resolve().parent.parent / "resources"
+REGISTRY_PATH = RESOURCES_PATH / "registry.json"
+
+# The listing has a main-image-url and other-image-url1 to 8
+MAX_VIEWS = 9
+
+# Fonts, canvases and templates as loaded by `load_registry`
+_registry = {}
+
+# Scratch surface for measuring text; sizes don't depend on the canvas
+_measure_draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+
+# Template name -> decoded image.  These are never drawn on; renders get a
+# copy from `get_template`.
+_templates = {}
+
+
+def load_registry(registry_path=REGISTRY_PATH):
+    # Font and template files are relative to the registry file.  PIL
+    # doesn't accept `Path` objs for fonts, so paths are kept as strings.
+    with open(registry_path) as f:
+        registry = json.load(f)
+    base_path = Path(registry_path).resolve().parent
+    for font in registry["fonts"].values():
+        font["path"] = str(base_path / font["file"])
+        font["canvas"] = tuple(registry["canvases"][font["canvas"]])
+    registry["templates"] = {
+        name: str(base_path / file) for name, file in registry["templates"].items()
+    }
+    for view in registry.get("views", {}).values():
+        if "slogan_xy" in view:
+            view["slogan_xy"] = tuple(view["slogan_xy"])
+        if "inset" in view:
+            view["inset"]["xy"] = tuple(view["inset"]["xy"])
+    set_registry(registry)
+    return registry
+
+
+def set_registry(registry):
+    # `registry` may be `_registry` itself, e.g. in a forked worker
+    registry = dict(registry)
+    _registry.clear()
+    _registry.update(registry)
+    _templates.clear()
+    text_size.cache_clear()
+
+
+def get_registry():
+    if not _registry:
+        load_registry()
+    return _registry
+
+
+def check_registry():
+    # Run once at startup.  Fonts whose file is missing are dropped, so rows
+    # using them fail validation instead of failing one by one at render
+    # time.  Returns the problems found.
+    registry = get_registry()
+    problems = []
+    for name, path in registry["templates"].items():
+        if not Path(path).is_file():
+            raise FileNotFoundError(f"Template {name} not found at {path}")
+    for name, font in list(registry["fonts"].items()):
+        if not Path(font["path"]).is_file():
+            problems.append(f"Font {name} not found at {font['path']}")
+            del registry["fonts"][name]
+            continue
+        for key in ("size", "max_chars", "max_lines"):
+            if not isinstance(font[key], int) or font[key] <= 0:
+                problems.append(f"Font {name} has an invalid {key}: {font[key]}")
+                del registry["fonts"][name]
+                break
+    if registry["default_font"] not in registry["fonts"]:
+        raise ValueError(f"Default font {registry['default_font']} is not usable")
+    check_views(registry)
+    return problems
+
+
+def check_views(registry):
+    # A view either has the slogan pasted on its template at "slogan_xy",
+    # or shows an earlier slogan view scaled down ("inset")
+    views = registry.get("views")
+    if not views:
+        raise ValueError("Registry has no views")
+    if len(views) > MAX_VIEWS:
+        raise ValueError(f"Registry has {len(views)} views, the listing takes {MAX_VIEWS}")  # noqa:E501
+    slogan_views = set()
+    for name, view in views.items():
+        if view.get("template") not in registry["templates"]:
+            raise ValueError(f"View {name} has an unknown template {view.get('template')}")  # noqa:E501
+        if "inset" in view:
+            if view["inset"]["view"] not in slogan_views:
+                raise ValueError(
+                    f"View {name} shows {view['inset']['view']}, which must be an "
+                    f"earlier view with the slogan on it")
+            if not 0 < view["inset"]["scale"] <= 1:
+                raise ValueError(f"View {name} has an invalid inset scale")
+        elif "slogan_xy" in view:
+            slogan_views.add(name)
+        else:
+            raise ValueError(f"View {name} needs a slogan_xy or an inset")
+
+
+def get_font_spec(font_name):
+    return get_registry()["fonts"][font_name]
+
+
+def get_views():
+    # View name -> view, in listing order
+    return get_registry()["views"]
+
+
+def _decode_template(template_name):
+    template_img = Image.open(get_registry()["templates"][template_name])
+    template_img.load()
+    return template_img
+
+
+def dump_templates(dump_dir):
+    # Decode every template once and write its raw pixels to `dump_dir`,
+    # so other processes can map them instead of decoding the PNGs again.
+    # Returns the manifest `load_templates` expects.
+    Path(dump_dir).mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    for template_name in get_registry()["templates"]:
+        template_img = get_template_master(template_name)
+        raw_path = Path(dump_dir) / f"{template_name}.raw"
+        with open(raw_path, "wb") as f:
+            f.write(template_img.tobytes())
+        manifest[template_name] = {
+            "path": str(raw_path),
+            "mode": template_img.mode,
+            "size": template_img.size,
+            # ICC profile etc., which `save` writes back out
+            "info": dict(template_img.info)
+        }
+    return manifest
+
+
+def load_templates(manifest=None):
+    # With a manifest from `dump_templates` the raw dumps are memory-mapped,
+    # so every process shares the same pages; otherwise the PNGs are decoded.
+    for template_name in get_registry()["templates"]:
+        if manifest is None:
+            _templates[template_name] = _decode_template(template_name)
+            continue
+        entry = manifest[template_name]
+        with open(entry["path"], "rb") as f:
+            raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        template_img = Image.frombuffer(
+            entry["mode"], tuple(entry["size"]), raw, "raw", entry["mode"], 0, 1)
+        template_img.info.update(entry["info"])
+        _templates[template_name] = template_img
+
+
+def get_template_master(template_name):
+    if template_name not in _templates:
+        _templates[template_name] = _decode_template(template_name)
+    return _templates[template_name]
+
+
+def get_template(template_name):
+    # A private copy to paste onto; a memcpy, not a PNG decode
+    return get_template_master(template_name).copy()
+
+
+@lru_cache(maxsize=None)
+def load_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+def get_font(font_name, font_size=None):
+    # Parsed once per (font name, size) for the life of the process
+    font = get_font_spec(font_name)
+    return load_font(font["path"], font_size or font["size"])
+
+
+@lru_cache(maxsize=8192)
+def text_size(font_name, text, font_size=None):
+    # Slogans repeat most of their lines ("This Mug Belongs To"), so the
+    # measurements are cached as well as the fonts
+    return _measure_draw.textsize(text, font=get_font(font_name, font_size))
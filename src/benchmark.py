@@ -0,0 +1,315 @@
+import argparse
+from assets import check_registry, get_registry, get_views, load_registry
+from botocore.exceptions import ClientError
+from datetime import datetime
+import json
+import numpy as np
+import os
+from pathlib import Path
+import PIL
+import platform
+import random
+import render_mugs
+import s3_upload
+import subprocess
+import sys
+import tempfile
+import time
+import timings
+
+# Words of every length up to the longest any font allows
+WORDS = [
+    "a", "to", "the", "best", "mugs", "coffee", "morning", "teachers",
+    "wonderful", "grandfather", "extraordinary", "I", "am", "my", "cup",
+    "love", "world", "nurse", "happy", "dad", "mom", "of", "this", "belongs",
+    "Mr.", "Smith's", "birthday", "anniversary", "coworkers"
+]
+DEFAULT_ROWS = 8
+DEFAULT_REPEAT = 3
+DEFAULT_RESULTS_DIR = Path(".mugup_cache/benchmarks")
+# Slowdowns smaller than either of these are noise
+DEFAULT_THRESHOLD = 0.10
+DEFAULT_MIN_MS = 1.0
+
+
+def synthetic_slogan(rng, max_chars, max_lines):
+    lines = []
+    for _ in range(rng.randint(1, max_lines)):
+        line = rng.choice([word for word in WORDS if len(word) <= max_chars])
+        while True:
+            word = rng.choice(WORDS)
+            if len(line) + 1 + len(word) > max_chars:
+                break
+            line = f"{line} {word}"
+        lines.append(line)
+    return " ".join(lines)
+
+
+def synthetic_rows(font_name, count, seed=0):
+    # Input rows as in the CSV, the same ones for a given seed
+    font = get_registry()["fonts"][font_name]
+    rng = random.Random(f"{seed}-{font_name}")
+    return [
+        {
+            "slogan": synthetic_slogan(rng, font["max_chars"], font["max_lines"]),
+            "niche": f"bench-{font_name}",
+            "item_name": f"Benchmark Mug {i}",
+            "keywords": "Benchmark, Mug",
+            "font": font_name
+        }
+        for i in range(count)
+    ]
+
+
+def benchmark_case(rows, supersample=None, endpoint_url=None, repeat=DEFAULT_REPEAT):
+    # Runs `rows` through validation, render, upload when there is an
+    # endpoint, and the listing, `repeat` times in this process.  Returns
+    # the stage summary of `timings` plus the end-to-end seconds per row.
+    render_options = {
+        "in_memory": True,
+        "supersample": supersample,
+        "registry": get_registry(),
+        "timings": True
+    }
+    render_mugs.init_render_worker(render_options)
+    # Warm up outside the timings
+    warm_up = [dict(row) for row in rows[:1]]
+    for slogan in render_mugs.validate_slogans(warm_up):
+        render_mugs.render_slogan_in_worker(slogan)
+    timings.take_samples()
+
+    seconds_per_row = []
+    for _ in range(repeat):
+        # Every run starts from the caches a new worker has, or later runs
+        # would reuse the lines and patterns of the first
+        render_mugs.init_render_worker(render_options)
+        run_start = time.perf_counter()
+        slogans = render_mugs.validate_slogans([dict(row) for row in rows])
+        rendered = list(render_mugs.skip_failed(
+            render_mugs.render_slogan_in_worker(slogan) for slogan in slogans))
+        if endpoint_url:
+            uploaded = list(render_mugs.skip_failed(
+                render_mugs.upload_slogans(rendered, endpoint_url=endpoint_url)))
+        else:
+            uploaded = rendered
+            for slogan in uploaded:
+                for view in get_views():
+                    slogan[f"{view}_url"] = f"https://example.com/{slogan['name']}"
+        render_mugs.create_amazon_upload_file(uploaded)
+        seconds_per_row.append((time.perf_counter() - run_start) / len(rows))
+
+    summary = timings.summarize(sum(seconds_per_row) * len(rows))
+    timings.take_samples()
+    return {
+        "rows": len(rows),
+        "repeat": repeat,
+        "end_to_end": {
+            "seconds_per_row": float(np.median(seconds_per_row)),
+            "rows_per_second": 1 / float(np.median(seconds_per_row))
+        },
+        "stages": summary["stages"]
+    }
+
+
+def ensure_bucket(endpoint_url):
+    s3 = s3_upload.make_s3_client(endpoint_url=endpoint_url)
+    try:
+        s3.head_bucket(Bucket=s3_upload.BUCKET)
+    except ClientError:
+        s3.create_bucket(Bucket=s3_upload.BUCKET)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(font_names, rows_per_font=DEFAULT_ROWS, supersamples=(None,),
+                   endpoint_url=None, repeat=DEFAULT_REPEAT, seed=0):
+    # One case per font and canvas: the font's own canvas, or a supersample
+    # factor.  Runs in a scratch directory so the listings and any
+    # slogan_errors.csv don't land in the checkout.
+    if endpoint_url:
+        ensure_bucket(endpoint_url)
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "rows_per_font": rows_per_font,
+        "repeat": repeat,
+        "seed": seed,
+        "upload": bool(endpoint_url),
+        "cases": {}
+    }
+    timings.enable()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        os.chdir(scratch_dir)
+        try:
+            for font_name in font_names:
+                rows = synthetic_rows(font_name, rows_per_font, seed)
+                for supersample in supersamples:
+                    case = f"{font_name}@{supersample}x" if supersample else font_name
+                    print(f"Benchmark {case}")
+                    results["cases"][case] = benchmark_case(
+                        rows, supersample, endpoint_url, repeat)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare_results(old, new, threshold=DEFAULT_THRESHOLD, min_ms=DEFAULT_MIN_MS):
+    # (case, stage, old seconds, new seconds, slower) for every stage the
+    # two runs share, comparing medians.  `slower` means more than
+    # `threshold` and `min_ms` slower.
+    comparisons = []
+    for case, new_case in new["cases"].items():
+        old_case = old["cases"].get(case)
+        if old_case is None:
+            continue
+        pairs = [(
+            "end_to_end",
+            old_case["end_to_end"]["seconds_per_row"],
+            new_case["end_to_end"]["seconds_per_row"]
+        )]
+        for stage, stats in new_case["stages"].items():
+            if stage in old_case["stages"]:
+                pairs.append((
+                    stage,
+                    old_case["stages"][stage]["quantiles"]["0.5"],
+                    stats["quantiles"]["0.5"]
+                ))
+        for stage, old_seconds, new_seconds in pairs:
+            slower = (new_seconds > old_seconds * (1 + threshold)
+                      and (new_seconds - old_seconds) * 1000 > min_ms)
+            comparisons.append((case, stage, old_seconds, new_seconds, slower))
+    return comparisons
+
+
+def print_results(results):
+    print(f"{'case':<16} {'stage':<10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9}")
+    for case, case_results in results["cases"].items():
+        for stage, stats in case_results["stages"].items():
+            p50, p95, p99 = (
+                stats["quantiles"][str(q)] * 1000 for q in timings.QUANTILES)
+            print(f"{case:<16} {stage:<10} {stats['count']:>7} {p50:>9.1f} "
+                  f"{p95:>9.1f} {p99:>9.1f}")
+        seconds_per_row = case_results["end_to_end"]["seconds_per_row"]
+        print(f"{case:<16} {'per row':<10} {case_results['rows']:>7} "
+              f"{seconds_per_row * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    # e.g. python src/benchmark.py run, then after a change
+    # python src/benchmark.py compare .mugup_cache/benchmarks/<old>.json
+    # .mugup_cache/benchmarks/<new>.json
+    p = argparse.ArgumentParser()
+    commands = p.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Benchmark the current tree.")
+    run.add_argument(
+        "--registry",
+        default=None,
+        help="Asset registry JSON to use instead of the bundled one."
+    )
+    run.add_argument(
+        "--fonts",
+        nargs="+",
+        default=None,
+        help="Fonts to benchmark, all of the registry's by default."
+    )
+    run.add_argument(
+        "--rows",
+        type=int,
+        default=DEFAULT_ROWS,
+        help="Synthetic slogans per font."
+    )
+    run.add_argument(
+        "--supersample",
+        nargs="+",
+        default=["native"],
+        choices=["native"] + [str(f) for f in render_mugs.SUPERSAMPLE_FACTORS],
+        help="Canvases to render on: the font's own and/or supersample factors."
+    )
+    run.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Times to run each case."
+    )
+    run.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the synthetic slogans."
+    )
+    run.add_argument(
+        "--s3_endpoint_url",
+        default=os.environ.get("S3_ENDPOINT_URL"),
+        help="Local S3 stand-in, e.g. MinIO, to benchmark uploads against.  "
+             "Uploads are left out without one."
+    )
+    run.add_argument(
+        "--output",
+        default=None,
+        help=f"Where to save the results. Default "
+             f"{DEFAULT_RESULTS_DIR}/<commit>.json."
+    )
+
+    compare = commands.add_parser(
+        "compare", help="Flag slowdowns between two saved runs.")
+    compare.add_argument("old", help="Results of the baseline run.")
+    compare.add_argument("new", help="Results of the run to check.")
+    compare.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Flag medians slower by more than this fraction."
+    )
+    compare.add_argument(
+        "--min_ms",
+        type=float,
+        default=DEFAULT_MIN_MS,
+        help="Ignore slowdowns of less than this many milliseconds."
+    )
+    args = p.parse_args(sys.argv[1:])
+
+    if args.command == "run":
+        if args.registry:
+            load_registry(args.registry)
+        for problem in check_registry():
+            print(problem)
+        supersamples = [
+            None if value == "native" else int(value) for value in args.supersample]
+        results = run_benchmarks(
+            args.fonts or list(get_registry()["fonts"]), args.rows, supersamples,
+            args.s3_endpoint_url, args.repeat, args.seed)
+        output = Path(args.output or DEFAULT_RESULTS_DIR / f"{results['commit']}.json")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=2) + "\n")
+        print_results(results)
+        print(f"Saved to {output}")
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        print(f"{old['commit']} -> {new['commit']}")
+        comparisons = compare_results(old, new, args.threshold, args.min_ms)
+        for case, stage, old_seconds, new_seconds, slower in comparisons:
+            change = (new_seconds / old_seconds - 1) * 100 if old_seconds else 0
+            print(f"{case:<16} {stage:<10} {old_seconds * 1000:>9.1f} "
+                  f"{new_seconds * 1000:>9.1f} {change:>+7.1f}%"
+                  f"{'  SLOWER' if slower else ''}")
+        if any(slower for *_, slower in comparisons):
+            sys.exit(1)
@@ -0,0 +1,131 @@
+import argparse
+from io import BytesIO
+from PIL import Image
+import sys
+import time
+
+# Output formats for the mug renders.  "opaque" profiles drop the alpha
+# channel; the mug composites have none that shows, their templates being
+# opaque.  "palette" quantises to 256 colours first.
+PROFILES = {
+    # Pillow's defaults, which the renders have always used
+    "png": {
+        "format": "PNG", "extension": "png", "content_type": "image/png",
+        "options": {}
+    },
+    "png-fast": {
+        "format": "PNG", "extension": "png", "content_type": "image/png",
+        "options": {"compress_level": 1}
+    },
+    "png-small": {
+        "format": "PNG", "extension": "png", "content_type": "image/png",
+        "options": {"optimize": True}
+    },
+    "png-palette": {
+        "format": "PNG", "extension": "png", "content_type": "image/png",
+        "options": {}, "palette": True
+    },
+    "jpeg": {
+        "format": "JPEG", "extension": "jpg", "content_type": "image/jpeg",
+        "options": {"quality": 90, "optimize": True}, "opaque": True
+    },
+    "webp": {
+        "format": "WEBP", "extension": "webp", "content_type": "image/webp",
+        "options": {"quality": 90, "method": 4}, "opaque": True
+    },
+}
+
+DEFAULT_PROFILE = "png"
+
+
+def prepare_image(img, profile_name):
+    profile = PROFILES[profile_name]
+    if profile.get("opaque") and img.mode in ("RGBA", "LA", "P"):
+        # Flatten onto white rather than letting the encoder drop alpha
+        img = img.convert("RGBA")
+        flat_img = Image.new("RGB", img.size, (255, 255, 255))
+        flat_img.paste(img, mask=img.getchannel("A"))
+        img = flat_img
+    if profile.get("palette"):
+        img = img.quantize(256, method=Image.FASTOCTREE)
+    return img
+
+
+def encode_image(img, profile_name=DEFAULT_PROFILE):
+    profile = PROFILES[profile_name]
+    buffer = BytesIO()
+    prepare_image(img, profile_name).save(
+        buffer, format=profile["format"], **profile["options"])
+    return buffer.getvalue()
+
+
+def save_image(img, path, profile_name=DEFAULT_PROFILE):
+    profile = PROFILES[profile_name]
+    prepare_image(img, profile_name).save(
+        path, format=profile["format"], **profile["options"])
+
+
+def parse_profile_arg(value):
+    # "PROFILE" for every view or "VIEW=PROFILE" for one, as (view, profile)
+    view, _, profile_name = value.rpartition("=")
+    if profile_name not in PROFILES:
+        raise argparse.ArgumentTypeError(
+            f"Unknown encoder profile {profile_name}, "
+            f"choose from {', '.join(PROFILES)}")
+    return view or None, profile_name
+
+
+def get_view_profiles(views, profile_args):
+    # View -> profile name from `parse_profile_arg` results, later ones
+    # winning.  Returns None when every view uses the default.
+    view_profiles = dict.fromkeys(views, DEFAULT_PROFILE)
+    for view, profile_name in profile_args or []:
+        if view is None:
+            view_profiles = dict.fromkeys(views, profile_name)
+        elif view not in view_profiles:
+            raise ValueError(f"Unknown view {view}, choose from {', '.join(views)}")
+        else:
+            view_profiles[view] = profile_name
+    if all(name == DEFAULT_PROFILE for name in view_profiles.values()):
+        return None
+    return view_profiles
+
+
+def benchmark_profiles(images, repeat=3):
+    # {profile: (seconds per image, bytes per image)}, best of `repeat`
+    results = {}
+    for profile_name in PROFILES:
+        best_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            total_bytes = sum(len(encode_image(img, profile_name)) for img in images)
+            elapsed = time.perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        results[profile_name] = (best_time / len(images), total_bytes / len(images))
+    return results
+
+
+if __name__ == "__main__":
+    # e.g. python src/encoders.py render/*_left.png, after a run with
+    # --save_renders
+    p = argparse.ArgumentParser()
+    p.add_argument("images", nargs="+", help="Renders to encode.")
+    p.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Encode each image this many times and keep the fastest."
+    )
+    args = p.parse_args(sys.argv[1:])
+
+    images = []
+    for image_path in args.images:
+        img = Image.open(image_path)
+        img.load()
+        images.append(img)
+
+    print(f"{'profile':<12} {'ms/image':>10} {'KB/image':>10}")
+    results = benchmark_profiles(images, args.repeat)
+    for profile_name, (seconds, size) in results.items():
+        print(f"{profile_name:<12} {seconds * 1000:>10.1f} {size / 1024:>10.1f}")
@@ -0,0 +1,91 @@
+import json
+import logging
+from pathlib import Path
+import render_cache
+
+DEFAULT_JOURNAL_DIR = Path(".mugup_cache/jobs")
+
+# The stages a row is recorded at, in order
+STAGES = ("rendered", "uploaded", "listed")
+
+
+def journal_path(input_file, journal_dir=DEFAULT_JOURNAL_DIR):
+    # One journal per input file
+    return Path(journal_dir) / f"{Path(input_file).stem}.jsonl"
+
+
+def row_key(slogan):
+    # Identifies a validated row across runs by its position and content.
+    # Not by its name, which has the date in it.
+    return render_cache.cache_key(
+        {field: value for field, value in slogan.items() if field != "name"})
+
+
+def load_journal(path):
+    # Row key -> the entry of the furthest stage the row got to.  A run that
+    # crashed mid-write can leave a torn last line, which is ignored.
+    entries = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                latest = entries.get(entry["key"])
+                if (latest is None or STAGES.index(entry["stage"])
+                        >= STAGES.index(latest["stage"])):
+                    entries[entry["key"]] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def open_journal(path, resume=False):
+    # Returns the entries of earlier runs, empty unless `resume`, and the
+    # journal opened for appending.  Without `resume` it starts over.
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    entries = load_journal(path) if resume else {}
+    return entries, open(path, "a" if resume else "w")
+
+
+def record(journal_file, slogan, stage, **fields):
+    # One JSON line per row and stage, flushed so it survives a crash
+    entry = {"key": slogan["job_key"], "row": slogan["row"], "stage": stage}
+    entry.update(fields)
+    journal_file.write(json.dumps(entry) + "\n")
+    journal_file.flush()
+
+
+def resume_slogans(entries, slogans, views):
+    # Drops slogans an earlier run listed and gives the ones it uploaded
+    # their URLs back, so they skip rendering and upload
+    skipped = 0
+    for slogan in slogans:
+        slogan["job_key"] = row_key(slogan)
+        entry = entries.get(slogan["job_key"])
+        if entry and entry["stage"] == "listed":
+            skipped += 1
+            continue
+        if entry and entry["stage"] == "uploaded" and set(entry["urls"]) >= set(views):
+            for view in views:
+                slogan[f"{view}_url"] = entry["urls"][view]
+        yield slogan
+    if skipped:
+        logging.info(f"Skipped {skipped} rows listed by an earlier run")
+
+
+def record_stage(journal_file, slogans, stage, views=None):
+    # Passes `slogans` on, recording each as having reached `stage`.  With
+    # `views`, their URLs are recorded too.
+    for slogan in slogans:
+        if views is None:
+            record(journal_file, slogan, stage)
+        else:
+            urls = {view: slogan[f"{view}_url"] for view in views}
+            record(journal_file, slogan, stage, urls=urls)
+        yield slogan
+
+
+def count_listed(entries):
+    return sum(1 for entry in entries.values() if entry["stage"] == "listed")
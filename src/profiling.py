@@ -0,0 +1,127 @@
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import os
+from pathlib import Path
+import pstats
+import sys
+import threading
+import tracemalloc
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+# A worker thread sitting in one of these is idle, not uploading
+_IDLE_FILES = ("threading.py", "queue.py", "thread.py")
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})"
+
+
+def _collapse(frame, thread_name):
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    # Pool threads are told apart by a suffix; count them as one
+    stack.append(thread_name.rsplit("_", 1)[0])
+    return ";".join(reversed(stack))
+
+
+@contextmanager
+def sample_stacks(interval=SAMPLE_INTERVAL):
+    # Counts the stacks of every thread but this one every `interval`
+    # seconds, as collapsed stack -> samples.  Unlike cProfile this sees the
+    # upload threads too.
+    counts = Counter()
+    stop = threading.Event()
+    main_id = threading.get_ident()
+
+    def sample():
+        own_id = threading.get_ident()
+        while not stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if (thread_id != main_id
+                        and os.path.basename(frame.f_code.co_filename) in _IDLE_FILES):
+                    continue
+                counts[_collapse(frame, names.get(thread_id, "thread"))] += 1
+
+    sampler = threading.Thread(target=sample, name="stack-sampler", daemon=True)
+    sampler.start()
+    try:
+        yield counts
+    finally:
+        stop.set()
+        sampler.join()
+
+
+def write_collapsed(counts, path):
+    # One "frame;frame;frame count" line per stack, as flamegraph.pl and
+    # speedscope read them
+    with open(path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def write_memory_report(stage, peak, current, snapshot, path):
+    lines = [
+        f"{stage}: peak {peak / 1024 / 1024:.1f} MB, "
+        f"{current / 1024 / 1024:.1f} MB allocated in it still alive at the end",
+        "",
+        f"Largest allocations still alive at the end of {stage}:"
+    ]
+    stats = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        # The stack sampler's own counts
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ]).statistics("lineno")
+    for stat in stats[:TOP_ALLOCATIONS]:
+        lines.append(str(stat))
+    Path(path).write_text("\n".join(lines) + "\n")
+
+
+@contextmanager
+def profile_stage(stage, output_dir):
+    # Profiles the `with` block deterministically with cProfile, samples its
+    # stacks and traces its memory.  Writes to `output_dir`:
+    #   <stage>.prof           cProfile stats, for pstats or snakeviz
+    #   <stage>_hotspots.txt   the top functions by cumulative and own time
+    #   <stage>.collapsed      sampled stacks for a flame graph
+    #   <stage>_memory.txt     peak memory and the biggest allocations
+    # tracemalloc slows everything down, so time is better read off the
+    # proportions than the absolute numbers.
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Traced afresh per stage, so the peak is the stage's own
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    with sample_stacks() as counts:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    profiler.dump_stats(output_dir / f"{stage}.prof")
+    with open(output_dir / f"{stage}_hotspots.txt", "w") as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        stats.sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+    write_collapsed(counts, output_dir / f"{stage}.collapsed")
+    write_memory_report(
+        stage, peak, current, snapshot, output_dir / f"{stage}_memory.txt")
+    print(f"Profiled {stage}: peak memory {peak / 1024 / 1024:.1f} MB, "
+          f"{sum(counts.values())} stack samples")
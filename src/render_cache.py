@@ -0,0 +1,157 @@
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from shutil import copyfile, rmtree
+
+DEFAULT_CACHE_PATH = Path(".mugup_cache/renders")
+DEFAULT_MAX_MB = 2048
+# Each entry's {view: sha256 of its render}, checked on every fetch
+CHECKSUMS_NAME = "checksums.json"
+
+
+@lru_cache(maxsize=None)
+def file_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(*parts):
+    # Parts must be JSON-serialisable; tuples and lists hash the same
+    key_source = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src_path, dest_path):
+    # Hands out a cached render.  A hard link is as good as a copy as long
+    # as the render is never written through, which is why `render_slogan`
+    # unlinks a render path before saving to it.
+    if os.path.lexists(dest_path):
+        os.unlink(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        copyfile(src_path, dest_path)
+
+
+def _entry_path(cache_dir, key):
+    return Path(cache_dir) / key[:2] / key
+
+
+def _bytes_checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _entry_intact(entry_path, view_bytes):
+    # Whether the entry's renders are still the ones stored.  A damaged
+    # entry, e.g. one written through a hard link, or one from before the
+    # checksums, is dropped so the render is stored afresh.
+    try:
+        checksums = json.loads((entry_path / CHECKSUMS_NAME).read_text())
+    except (OSError, ValueError):
+        checksums = {}
+    if all(checksums.get(view) == _bytes_checksum(data)
+           for view, data in view_bytes.items()):
+        return True
+    logging.warning(f"Dropping changed render cache entry {entry_path.name}")
+    rmtree(entry_path, ignore_errors=True)
+    return False
+
+
+def fetch(cache_dir, key, dest_paths):
+    # dest_paths {view name: path to put the cached render at}.  Returns
+    # False, leaving nothing behind, unless every view is cached.
+    entry_path = _entry_path(cache_dir, key)
+    cached_paths = {view: entry_path / f"{view}.png" for view in dest_paths}
+    try:
+        view_bytes = {view: path.read_bytes() for view, path in cached_paths.items()}
+    except OSError:
+        return False
+    if not _entry_intact(entry_path, view_bytes):
+        return False
+    for view, dest_path in dest_paths.items():
+        _link_or_copy(cached_paths[view], dest_path)
+    # Mark as recently used for `evict`
+    os.utime(entry_path)
+    return True
+
+
+def fetch_bytes(cache_dir, key, views):
+    # Like `fetch`, for renders kept in memory.  Returns {view: PNG bytes},
+    # or None unless every view is cached.
+    entry_path = _entry_path(cache_dir, key)
+    try:
+        view_bytes = {
+            view: (entry_path / f"{view}.png").read_bytes() for view in views
+        }
+    except OSError:
+        return None
+    if not _entry_intact(entry_path, view_bytes):
+        return None
+    os.utime(entry_path)
+    return view_bytes
+
+
+def _store_entry(cache_dir, key, write_view, views):
+    entry_path = _entry_path(cache_dir, key)
+    if entry_path.is_dir():
+        return
+    # Build the entry next to its final place and rename it in, so other
+    # workers never see a half-written entry
+    tmp_path = entry_path.with_name(f"{key}.{os.getpid()}.tmp")
+    try:
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        checksums = {}
+        for view in views:
+            checksums[view] = write_view(view, tmp_path / f"{view}.png")
+        (tmp_path / CHECKSUMS_NAME).write_text(json.dumps(checksums))
+        os.rename(tmp_path, entry_path)
+    except OSError as e:
+        # Most likely another worker stored the same render first
+        logging.info(f"Render cache store skipped: {e}")
+        rmtree(tmp_path, ignore_errors=True)
+
+
+def store(cache_dir, key, src_paths):
+    # Copies rather than links, so the entry doesn't change if the render
+    # path is saved to again
+    def write_view(view, cache_path):
+        data = Path(src_paths[view]).read_bytes()
+        cache_path.write_bytes(data)
+        return _bytes_checksum(data)
+
+    _store_entry(cache_dir, key, write_view, src_paths)
+
+
+def store_bytes(cache_dir, key, view_bytes):
+    def write_view(view, cache_path):
+        cache_path.write_bytes(view_bytes[view])
+        return _bytes_checksum(view_bytes[view])
+
+    _store_entry(cache_dir, key, write_view, view_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    # Drop least recently used entries until the cache fits in `max_bytes`
+    entries = []
+    total_bytes = 0
+    for entry_path in Path(cache_dir).glob("*/*"):
+        if not entry_path.is_dir() or entry_path.suffix == ".tmp":
+            continue
+        entry_bytes = sum(f.stat().st_size for f in entry_path.iterdir())
+        entries.append((entry_path.stat().st_mtime, entry_bytes, entry_path))
+        total_bytes += entry_bytes
+
+    evicted = 0
+    for _, entry_bytes, entry_path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        rmtree(entry_path, ignore_errors=True)
+        total_bytes -= entry_bytes
+        evicted += 1
+    return evicted
@@ -1,1016 +1,1169 @@
+import amazon_listing
 import argparse
-import boto3
+from assets import (
+    check_registry, dump_templates, get_font, get_font_spec, get_registry,
+    get_template, get_template_master, get_views, load_registry, load_templates,
+    set_registry, text_size
+)
 import csv
+import encoders
+import journal
+from collections import OrderedDict
 from datetime import date, datetime
 import logging
-from math import ceil
+from functools import lru_cache
+from math import ceil, modf
+from multiprocessing import Pool
+from itertools import islice
 import numpy as np
 import os
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from progressbar import progressbar
+import profiling
+import render_cache
+import s3_upload
 from shutil import rmtree
 import sys
+import text_fit
+import timings
 from textwrap import wrap
+from threading import Event, Semaphore
+import time
+from warp import (
+    DEFLECTION, clear_shared_regions, combine_regions, get_warp_map, transform_region,
+    transform_shared_region, transform_slogan_legacy
+)
 
+RENDER_PATH = Path("render/")
 
-def validate_input(slogan_dicts):
-    def clean_whitespace(string):
-        string_split = string.split()
-        return " ".join(string_split)
+# Part of every render cache key; bump it when the render output changes
+RENDER_VERSION = 1
 
-    print("Clean out blank lines")
-    slogan_dicts_no_blank_lines = []
-    for slogan in progressbar(slogan_dicts):
-        if slogan["slogan"] != "":
-            slogan_dicts_no_blank_lines.append(slogan)
+# Width of the slogan on the mug renders, in px, unless a view says
+# otherwise in the registry
+FINAL_W = 1372
 
-    today = date.today().strftime("%Y%m%d")
-    errors = []
-    valid_slogans = []
-    print("Validate slogans")
-    for slogan in progressbar(slogan_dicts_no_blank_lines):
-        slogan["slogan"] = clean_whitespace(slogan["slogan"])
-        slogan["niche"] = clean_whitespace(slogan["niche"]).replace(" ", "-").lower()
-        slogan["row"] = slogan_dicts.index(slogan) + 2
-        slogan["name"] = f"{slogan['niche']}_{slogan_dicts.index(slogan)}_{today}"
-        error_obj = {
-            "row": int,
-            "error_count": int,
-            "error": ["error 1", "error n"]
-        }
+# Factors `--supersample` can draw and warp the slogan at, times the
+# slogan's width
+SUPERSAMPLE_FACTORS = (1, 2, 4)
 
-        error_obj["row"] = slogan["row"]
-        error_obj["error"] = []
-
-        # Check font
-        font_map = {
-            "abril": {"max_chars": 10, "max_lines": 6},
-            "amatic": {"max_chars": 14, "max_lines": 4},
-            "amatic-bold": {"max_chars": 14, "max_lines": 4},
-            "montserrat": {"max_chars": 10, "max_lines": 6},
-            "nickainley": {"max_chars": 10, "max_lines": 6},
-            "playfair": {"max_chars": 10, "max_lines": 6}
-        }
+# Work derived from the templates once per process for inset views, see
+# `get_scaled_template` and `get_inset_background`
+_scaled_templates = {}
+_inset_backgrounds = {}
+
+# Rasterised lines kept per process.  Templated catalogues repeat most
+# lines from row to row, e.g. all but the surname.
+LINE_CACHE_SIZE = 64
+
+# The fixed part of slogan patterns, see `render_pattern_layers`: key ->
+# {"warped": ..., "layer": ..., "bases": {view: template with it pasted}},
+# least recently used first.  The bases are a full template each.
+PATTERN_CACHE_SIZE = 4
+_pattern_layers = OrderedDict()
+
+# Output pixels either side of a pixel's own that a downscale reads from,
+# see `resize_region` and `resize_inset_region`: Lanczos reaches 3, plus 1
+# for rounding
+RESIZE_REACH = 4
+
+
+def clean_whitespace(string):
+    string_split = string.split()
+    return " ".join(string_split)
+
+
+def wrap_slogan(slogan_text, width):
+    # Same lines as `textwrap.wrap` for whitespace-cleaned text, which is
+    # most of the validation time.  Hyphens and words too long for a line
+    # are left to `wrap`, which splits them.
+    if not slogan_text:
+        return []
+    words = slogan_text.split(" ")
+    if "-" in slogan_text or max(map(len, words)) > width:
+        return wrap(slogan_text, width=width)
+    lines = []
+    line = words[0]
+    for word in words[1:]:
+        if len(line) + 1 + len(word) <= width:
+            line = f"{line} {word}"
+        else:
+            lines.append(line)
+            line = word
+    lines.append(line)
+    return lines
+
+
+def check_slogan(slogan, index, today, fit="rewrap"):
+    # Cleans `slogan` in place and fills in its row, name, limits and
+    # wrapped lines.  `index` is the slogan's position in the input file.
+    # `fit` is what to do with lines that would be clipped on the canvas:
+    # "rewrap" them by width, "reject" the slogan or "off" to not check.
+    # Returns the error row for slogan_errors.csv, or None if it's valid.
+    slogan["slogan"] = clean_whitespace(slogan["slogan"])
+    slogan["niche"] = clean_whitespace(slogan["niche"]).replace(" ", "-").lower()
+    slogan["row"] = index + 2
+    slogan["name"] = f"{slogan['niche']}_{index}_{today}"
+    error_obj = {
+        "row": int,
+        "error_count": int,
+        "error": ["error 1", "error n"]
+    }
+
+    error_obj["row"] = slogan["row"]
+    error_obj["error"] = []
+
+    # Check font
+    font_map = get_registry()["fonts"]
+    try:
+        if not slogan["font"]:
+            slogan["font"] = get_registry()["default_font"]
+        limits_dict = font_map[slogan["font"]]
+        slogan["max_chars"] = limits_dict["max_chars"]
+        slogan["max_lines"] = limits_dict["max_lines"]
+    except KeyError:
+        error_obj["error"].append(f"Font not found. Options are {font_map.keys()}.  Check for spaces")  # noqa: E501
+        slogan["max_chars"] = 14
+        slogan["max_lines"] = 4
         try:
-            if not slogan["font"]:
-                slogan["font"] = "abril"
-            limits_dict = font_map[slogan["font"]]
-            slogan["max_chars"] = limits_dict["max_chars"]
-            slogan["max_lines"] = limits_dict["max_lines"]
-        except KeyError:
-            error_obj["error"].append(f"Font not found. Options are {font_map.keys()}.  Check for spaces")  # noqa: E501
-            slogan["max_chars"] = 14
-            slogan["max_lines"] = 4
-            try:
-                error_obj["error_count"] += 1
-            except TypeError:
-                error_obj["error_count"] = 1
+            error_obj["error_count"] += 1
+        except TypeError:
+            error_obj["error_count"] = 1
 
-        # Check word length < max_chars
-        individual_words = slogan["slogan"].split()
-        words_exceeding_char_limit = 0
-        for word in individual_words:
-            word_len = len(word)
-            if word_len > slogan["max_chars"]:
-                words_exceeding_char_limit += 1
-        if words_exceeding_char_limit > 0:
-            error_obj["error"].append(f"{words_exceeding_char_limit} word(s) exceed(s) character limit.  Must be less than chars {slogan['max_chars']} for this font")  # noqa:E501
-            try:
-                error_obj["error_count"] += 1
-            except TypeError:
-                error_obj["error_count"] = 1
+    # Check word length < max_chars
+    individual_words = slogan["slogan"].split()
+    words_exceeding_char_limit = 0
+    for word in individual_words:
+        word_len = len(word)
+        if word_len > slogan["max_chars"]:
+            words_exceeding_char_limit += 1
+    if words_exceeding_char_limit > 0:
+        error_obj["error"].append(f"{words_exceeding_char_limit} word(s) exceed(s) character limit.  Must be less than chars {slogan['max_chars']} for this font")  # noqa:E501
+        try:
+            error_obj["error_count"] += 1
+        except TypeError:
+            error_obj["error_count"] = 1
 
-        # Check num of lines when wrapped
-        slogan["wrapped"] = wrap(slogan["slogan"], width=slogan["max_chars"])
-        num_of_lines = len(slogan["wrapped"])
-        if num_of_lines > slogan["max_lines"]:
-            error_obj["error"].append(f"Too many lines.  Make the slogan shorter")  # noqa:E501
+    # Check num of lines when wrapped
+    slogan["wrapped"] = wrap_slogan(slogan["slogan"], slogan["max_chars"])
+    num_of_lines = len(slogan["wrapped"])
+    if num_of_lines > slogan["max_lines"]:
+        error_obj["error"].append(f"Too many lines.  Make the slogan shorter")  # noqa:E501
+        try:
+            error_obj["error_count"] += 1
+        except TypeError:
+            error_obj["error_count"] = 1
+
+    # Check the lines fit the canvas, measured with the font itself
+    if fit != "off" and slogan["font"] in font_map and not error_obj["error"]:
+        fit_error = text_fit.check_fit(slogan["font"], slogan["wrapped"])
+        if fit_error and fit == "rewrap":
+            rewrapped = text_fit.fit_wrap(slogan["font"], slogan["slogan"])
+            if (len(rewrapped) <= slogan["max_lines"]
+                    and not text_fit.check_fit(slogan["font"], rewrapped)):
+                slogan["wrapped"] = rewrapped
+                fit_error = None
+        if fit_error:
+            error_obj["error"].append(fit_error)
             try:
                 error_obj["error_count"] += 1
             except TypeError:
                 error_obj["error_count"] = 1
 
-        # Append to `errors` list if any present
-        errors_present = type(error_obj["error_count"]) is int
-        if errors_present:
-            # convert errors to one string
-            error_str = ""
-            for idx, error in enumerate(error_obj["error"]):
-                idx += 1
-                new_str = f"#{idx} - {error} "
-                error_str += new_str
-            error_obj["error"] = error_str
-            errors.append(error_obj)
-        else:
-            valid_slogans.append(slogan)
-
-    # output csv with errors lists
-    if len(errors) > 0:
-        keys = errors[0].keys()
-        with open("slogan_errors.csv", "w") as error_output:
-            dict_writer = csv.DictWriter(error_output, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(errors)
-
-    return valid_slogans
-
-
-def render_mugs(valid_slogan_dicts):
-    def draw_slogan(MAX_W, MAX_H):
-        img = Image.new("RGBA", (MAX_W, MAX_H), (255, 255, 255, 0))
-        draw = ImageDraw.Draw(img)
-
-        # font_map {corresponds to slogan.font, [path, size]}
-        # Windows conversion problem in font paths but PIL
-        # doesn't accept `Path` obj
-        if sys.platform == "win32":
-            font_map = {
-                "abril": ["resources\\AbrilFatface-Regular.otf", 400],
-                "amatic": ["resources\\AmaticSC-Bold.ttf", 275],
-                "amatic-bold": ["resources\\Amatic-Bold.ttf", 275],
-                "montserrat": ["resources\\Montserrat-ExtraBold.otf", 384],
-                "nickainley": ["resources\\Nickainley-Normal.otf", 200],
-                "playfair": ["resources\\PlayfairDisplay-Black.otf", 215]
-            }
-        elif sys.platform == "darwin":
-            font_map = {
-                "abril": ["resources/AbrilFatface-Regular.otf", 400],
-                "amatic": ["resources/AmaticSC-Bold.ttf", 275],
-                "amatic-bold": ["resources/Amatic-Bold.ttf", 275],
-                "montserrat": ["resources/Montserrat-ExtraBold.otf", 384],
-                "nickainley": ["resources/Nickainley-Normal.otf", 200],
-                "playfair": ["resources/PlayfairDisplay-Black.otf", 215]
-            }
-        font = ImageFont.truetype(*font_map[slogan["font"]])
-
-        slogan_lines = slogan["wrapped"]
-
-        std_w, std_h = draw.textsize(slogan_lines[0], font=font)
-        text_h = len(slogan_lines) * std_h
-        starting_h = (MAX_H - text_h) / 2
-        current_h = starting_h - 60
-
-        for line in slogan["wrapped"]:
-            w, h = draw.textsize(line, font=font)
-            draw.text(((MAX_W - w) / 2, current_h), line, font=font, fill=(0, 0, 0))
-            current_h += std_h
-
-        return img
-
-    def transform_slogan(original_img):
-        def solve_quadratic_coeffs(point_1, point_2, point_3):
-            points = np.array([point_1, point_2, point_3])
-            x = points[:, 0]
-            y = points[:, 1]
-            z = np.polyfit(x, y, 2)
-            return z
-
-        def plot_deflected_point(x, a, b, height):
-            return int(a * x ** 2 + b * x + height)
-
-        def plot_alpha_point(x, d, e, f):
-            return d * x ** 2 + e * x + f
-
-        original_pixel = original_img.load()
-
-        # The new image will be tallest on the bottom and in
-        # the middle of the line.  So new height should be the
-        # original height plus the new y value at the bottom of
-        # the old image.
-        original_w = original_img.size[0]
-        original_h = original_img.size[1]
-
-        # Quadratic for deflection found by fitting 3 points
-        mid_x = original_w / 2
-        deflection = 0.075
-        mid_y = original_h * deflection
-
-        # Deflection eqn coeffs
-        a, b, c = solve_quadratic_coeffs(
-            point_1=(0, 0),
-            point_2=(mid_x, mid_y),
-            point_3=(original_w, 0)
-        )
-        new_h = int(ceil(plot_deflected_point(mid_x, a, b, original_h)))
-        new_img = Image.new("RGBA", (original_w, new_h), (255, 255, 255, 0))
-
-        # Alpha (opacity) eqn found by fitting 3 points
-        d, e, f = solve_quadratic_coeffs(
-            point_1=(0, 0.8),
-            point_2=(original_w / 4, 0.9),
-            point_3=(mid_x, 0.95)
-        )
+    # Return the errors, if any present
+    errors_present = type(error_obj["error_count"]) is int
+    if errors_present:
+        # convert errors to one string
+        error_str = ""
+        for idx, error in enumerate(error_obj["error"]):
+            idx += 1
+            new_str = f"#{idx} - {error} "
+            error_str += new_str
+        error_obj["error"] = error_str
+        return error_obj
+    return None
 
-        for x in range(original_w):  # cols
-            if x < mid_x:
-                alpha_value = int(ceil(plot_alpha_point(x, d, e, f) * 255))
-            else:
-                reflected_x = 2 * mid_x - x
-                alpha_value = int(ceil(plot_alpha_point(reflected_x, d, e, f) * 255))
-            for y in range(original_h):  # rows
-                current_pixel = original_pixel[x, y]
-                if current_pixel != (255, 255, 255, 0) and current_pixel != (0, 0, 0, 0):  # noqa:E501
-                    new_pixel = (current_pixel[0], current_pixel[1],
-                                 current_pixel[2], alpha_value)
-                    new_pixel_y = plot_deflected_point(x, a, b, y)
-                    try:
-                        new_img.putpixel((x, new_pixel_y), new_pixel)
-                    except Exception as e:
-                        logging.error(e)
-                        continue
-
-        return new_img
 
-    print("Create mug render images")
-    slogans_with_path = []
-    for slogan in progressbar(valid_slogan_dicts):
+def validate_input(slogan_dicts, fit="rewrap"):
+    # One pass over any iterable of rows, e.g. a `csv.DictReader`
+    print("Validate slogans")
+    return list(validate_slogans(progressbar(slogan_dicts), fit))
+
+
+def validate_slogans(slogan_rows, fit="rewrap"):
+    # Yields valid slogans as they are read, carrying their position in
+    # the input, and writes slogan_errors.csv as errors turn up.  Blank
+    # lines are skipped.
+    today = date.today().strftime("%Y%m%d")
+    error_output = None
+    dict_writer = None
+    try:
+        for index, slogan in enumerate(slogan_rows):
+            if slogan["slogan"] == "":
+                continue
+            with timings.span("validate"):
+                error_obj = check_slogan(slogan, index, today, fit)
+            if error_obj is None:
+                yield slogan
+                continue
+            if dict_writer is None:
+                error_output = open("slogan_errors.csv", "w")
+                dict_writer = csv.DictWriter(error_output, error_obj.keys())
+                dict_writer.writeheader()
+            dict_writer.writerow(error_obj)
+    finally:
+        if error_output is not None:
+            error_output.close()
+
+
+# Per-process render state, filled once by `init_render_worker`
+_render_options = {}
+
+
+def init_render_worker(render_options):
+    _render_options.clear()
+    _render_options.update(render_options)
+    _render_options.pop("template_manifest", None)
+    _render_options.pop("registry", None)
+    _render_options.pop("timings", None)
+    timings.enable(render_options.get("timings", False))
+    if render_options.get("registry"):
+        set_registry(render_options["registry"])
+    _scaled_templates.clear()
+    _inset_backgrounds.clear()
+    get_line_mask.cache_clear()
+    get_line_image.cache_clear()
+    clear_shared_regions()
+    _pattern_layers.clear()
+
+    # Load fonts, templates and warp maps up front so the first rows of
+    # every worker don't pay for it
+    for font_name in get_registry()["fonts"]:
         try:
-            # These fonts need a higher resolution
-            if slogan["font"] == "abril" or slogan["font"] == "montserrat":
-                STARTING_W, STARTING_H = 3000, 3122
+            get_font(font_name)
+        except OSError as e:
+            logging.error(f"{e}. Could not load font {font_name}")
+    load_templates(render_options.get("template_manifest"))
+    for view_name, view in get_views().items():
+        if "inset" in view:
+            get_inset_background(view_name)
+    if not render_options.get("legacy_warp"):
+        for deflection, slogan_width in get_slogan_layers():
+            for font_name in get_registry()["fonts"]:
+                canvas_size, _ = get_render_canvas(
+                    font_name, render_options.get("supersample"), slogan_width)
+                get_warp_map(
+                    *canvas_size, deflection,
+                    cache_dir=render_options.get("warp_cache_dir"))
+
+
+def get_slogan_layers():
+    # (deflection, width) of every warped slogan the views need.  Views
+    # that agree share one.
+    return {
+        (view.get("deflection", DEFLECTION), view.get("slogan_width", FINAL_W))
+        for view in get_views().values() if "slogan_xy" in view
+    }
+
+
+def get_render_canvas(font_name, supersample=None, slogan_width=FINAL_W):
+    # The canvas the slogan is drawn and warped on, and its scale relative
+    # to the font's own canvas in the registry.  With `supersample` it is
+    # that many times the slogan's final width, whatever the font.
+    canvas_w, canvas_h = get_font_spec(font_name)["canvas"]
+    if not supersample:
+        return (canvas_w, canvas_h), 1
+    scale = slogan_width * supersample / canvas_w
+    return (slogan_width * supersample, int(round(canvas_h * scale))), scale
+
+
+def get_slogan_font_size(slogan, scale=1):
+    # None is the font's own size
+    if scale == 1:
+        return None
+    return int(round(get_font_spec(slogan["font"])["size"] * scale))
+
+
+def layout_slogan(slogan, MAX_W, MAX_H, scale=1):
+    # Where `draw_slogan` puts each line: [(xy, line), ...].  `scale` is
+    # the canvas size relative to the font's canvas, see `get_render_canvas`.
+    slogan_lines = slogan["wrapped"]
+    font_size = get_slogan_font_size(slogan, scale)
+
+    std_w, std_h = text_size(slogan["font"], slogan_lines[0], font_size)
+    text_h = len(slogan_lines) * std_h
+    starting_h = (MAX_H - text_h) / 2
+    current_h = starting_h - text_fit.TEXT_OFFSET * scale
+
+    layout = []
+    for line in slogan_lines:
+        w, h = text_size(slogan["font"], line, font_size)
+        layout.append((((MAX_W - w) / 2, current_h), line))
+        current_h += std_h
+    return layout
+
+
+@lru_cache(maxsize=LINE_CACHE_SIZE)
+def get_line_mask(font_name, font_size, line, start):
+    # The line rasterised as `ImageDraw.text` does it, `start` being the
+    # fractions of the position it's drawn at, and the mask's offset from
+    # the whole pixel position
+    font = get_font(font_name, font_size)
+    mask, offset = font.getmask2(line, "L", start=start)
+    return Image.Image()._new(mask), offset
+
+
+@lru_cache(maxsize=LINE_CACHE_SIZE)
+def get_line_image(font_name, font_size, line, start):
+    # The line's mask drawn in black on a transparent image its size
+    mask, _ = get_line_mask(font_name, font_size, line, start)
+    line_img = Image.new("RGBA", mask.size, (255, 255, 255, 0))
+    ImageDraw.Draw(line_img).bitmap((0, 0), mask, fill=(0, 0, 0))
+    return line_img
+
+
+def place_line(font_name, font_size, line, xy):
+    # The line's mask and the box `ImageDraw.text` would draw it in at `xy`.
+    # Drawing the mask there with `ImageDraw.bitmap` gives the same pixels.
+    x, y = xy
+    mask, offset = get_line_mask(
+        font_name, font_size, line, (modf(x)[0], modf(y)[0]))
+    left = int(x) + offset[0]
+    top = int(y) + offset[1]
+    return mask, (left, top, left + mask.size[0], top + mask.size[1])
+
+
+def draw_slogan(slogan, MAX_W, MAX_H, scale=1):
+    img = Image.new("RGBA", (MAX_W, MAX_H), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    font_size = get_slogan_font_size(slogan, scale)
+
+    for xy, line in layout_slogan(slogan, MAX_W, MAX_H, scale):
+        mask, box = place_line(slogan["font"], font_size, line, xy)
+        draw.bitmap(box[:2], mask, fill=(0, 0, 0))
+
+    return img
+
+
+def draw_slogan_region(slogan, MAX_W, MAX_H, scale=1):
+    # Draws only the box around the text, plus a margin, instead of the
+    # whole canvas.  Returns the image and its (left, top) on the canvas;
+    # the pixels are the same as in `draw_slogan`.
+    font = get_font(slogan["font"], get_slogan_font_size(slogan, scale))
+    layout = layout_slogan(slogan, MAX_W, MAX_H, scale)
+
+    left, top, right, bottom = MAX_W, MAX_H, 0, 0
+    for (x, y), line in layout:
+        line_box = font.getbbox(line)
+        line_box = (x + line_box[0], y + line_box[1], x + line_box[2], y + line_box[3])  # noqa:E501
+        # The glyphs are rasterised relative to int(x), int(y) with the
+        # fractions as an offset.  Shifting the text by whole pixels that
+        # keep x and y on the same side of 0 keeps both the same.
+        left = min(left, line_box[0], x if x >= 0 else 0)
+        top = min(top, line_box[1], y if y >= 0 else 0)
+        right = max(right, line_box[2])
+        bottom = max(bottom, line_box[3])
+    left = max(0, int(left) - 2)
+    top = max(0, int(top) - 2)
+    right = min(MAX_W, int(ceil(right)) + 2)
+    bottom = min(MAX_H, int(ceil(bottom)) + 2)
+
+    img = Image.new(
+        "RGBA", (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    font_size = get_slogan_font_size(slogan, scale)
+    for xy, line in layout:
+        mask, box = place_line(slogan["font"], font_size, line, xy)
+        draw.bitmap((box[0] - left, box[1] - top), mask, fill=(0, 0, 0))
+
+    return img, (left, top)
+
+
+def place_slogan_lines(slogan, canvas_size, scale):
+    # [(line_img, box, line, xy), ...] of the slogan's lines that have
+    # pixels, see `place_line` and `get_line_image`, or None if lines
+    # overlap or reach the canvas edge, when they can't be warped apart
+    font_size = get_slogan_font_size(slogan, scale)
+    placed_lines = []
+    previous_bottom = 0
+    for xy, line in layout_slogan(slogan, *canvas_size, scale):
+        mask, box = place_line(slogan["font"], font_size, line, xy)
+        if mask.size[0] == 0 or mask.size[1] == 0:
+            continue
+        if (box[0] < 0 or box[1] < previous_bottom
+                or box[2] > canvas_size[0] or box[3] > canvas_size[1]):
+            return None
+        previous_bottom = box[3]
+        line_img = get_line_image(
+            slogan["font"], font_size, line, (modf(xy[0])[0], modf(xy[1])[0]))
+        placed_lines.append((line_img, box, line, xy))
+    return placed_lines or None
+
+
+def warp_placed_lines(font_name, font_size, placed_lines, canvas_size,
+                      deflection=DEFLECTION, warp_cache_dir=None):
+    # Warps `place_slogan_lines` lines one by one, reusing the warps of
+    # lines earlier slogans had, see `transform_shared_region`.  Returns
+    # the image and (left, top) of them all warped.
+    warped_lines = []
+    for line_img, box, line, xy in placed_lines:
+        # The line's pixels depend on where it is within a pixel
+        key = (font_name, font_size, line, xy[0], modf(xy[1])[0])
+        warped_img, warped_top = transform_shared_region(
+            key, lambda line_img=line_img: line_img, box[0], box[1], line_img.size,
+            canvas_size, deflection, warp_cache_dir)
+        warped_lines.append((warped_img, (box[0], warped_top)))
+    return combine_regions(warped_lines)
+
+
+def resize_region(region_img, offset, full_size, size, resample=Image.LANCZOS):
+    # Resizes the part of a `full_size` image at `offset` as if the whole
+    # image were resized to `size`, everything outside the region being
+    # transparent.  Returns the output columns the region reaches, cropped
+    # to the rows it reaches, and their offset in the resized image.
+    #
+    # Pillow resamples rows then columns, and doesn't pass a crop box on
+    # exactly, so the two passes are run separately over whole rows and
+    # whole columns.  Transparent pixels are 0 once premultiplied, like
+    # `resize` does for RGBA, so the rest of the image adds nothing.
+    scale_x = full_size[0] / size[0]
+    scale_y = full_size[1] / size[1]
+    left = max(0, int(offset[0] / scale_x) - RESIZE_REACH)
+    top = max(0, int(offset[1] / scale_y) - RESIZE_REACH)
+    right = min(size[0], int(ceil((offset[0] + region_img.size[0]) / scale_x)) + RESIZE_REACH)  # noqa:E501
+    bottom = min(size[1], int(ceil((offset[1] + region_img.size[1]) / scale_y)) + RESIZE_REACH)  # noqa:E501
+
+    # Rows: the region's rows at full width
+    band_img = Image.new("RGBa", (full_size[0], region_img.size[1]))
+    band_img.paste(region_img.convert("RGBa"), (offset[0], 0))
+    band_img = band_img.resize(
+        (size[0], band_img.size[1]), resample,
+        (0, 0, full_size[0], band_img.size[1]))
+
+    # Columns: the columns the region reached, at full height
+    strip_img = Image.new("RGBa", (right - left, full_size[1]))
+    strip_img.paste(band_img.crop((left, 0, right, band_img.size[1])), (0, offset[1]))
+    strip_img = strip_img.resize(
+        (strip_img.size[0], size[1]), resample,
+        (0, 0, strip_img.size[0], full_size[1]))
+
+    resized_img = strip_img.crop((0, top, strip_img.size[0], bottom))
+    return resized_img.convert("RGBA"), (left, top)
+
+
+def resize_cells(region_img, offset, full_size, size):
+    # The output pixels of resizing a `full_size` image to `size` that the
+    # region's non-transparent pixels fall in
+    ys, xs = np.nonzero(np.asarray(region_img)[..., 3])
+    cells = np.zeros((size[1], size[0]), bool)
+    cells[
+        (ys + offset[1]) * size[1] // full_size[1],
+        (xs + offset[0]) * size[0] // full_size[0]
+    ] = True
+    return cells
+
+
+def regions_apart(region, other_region, full_size, size):
+    # Whether no output pixel of `resize_region` reads from both regions,
+    # each (image, offset) on the same `full_size` image.  If so, resizing
+    # them one by one gives the same pixels as resizing them together.
+    cells = resize_cells(*region, full_size, size)
+    other_cells = resize_cells(*other_region, full_size, size)
+    # Counts `cells` within reach of each of `other_cells` off a summed-area
+    # table
+    table = np.zeros((size[1] + 1, size[0] + 1), np.int32)
+    table[1:, 1:] = cells.cumsum(0).cumsum(1)
+    ys, xs = np.nonzero(other_cells)
+    reach = 2 * RESIZE_REACH + 1
+    top = np.clip(ys - reach, 0, size[1])
+    bottom = np.clip(ys + reach + 1, 0, size[1])
+    left = np.clip(xs - reach, 0, size[0])
+    right = np.clip(xs + reach + 1, 0, size[0])
+    counts = (table[bottom, right] - table[top, right]
+              - table[bottom, left] + table[top, left])
+    return not counts.any()
+
+
+def get_scaled_template(view_name, scale):
+    # A slogan view's template scaled down for the views showing it as an
+    # inset, worked out once per process:
+    #   "rows": premultiplied, resampled along its rows only
+    #   "small": fully resized, as `resize` would
+    key = (view_name, scale)
+    if key not in _scaled_templates:
+        template_img = get_template_master(get_views()[view_name]["template"])
+        small_size = (
+            int(ceil(template_img.size[0] * scale)),
+            int(ceil(template_img.size[1] * scale))
+        )
+        _scaled_templates[key] = {
+            "rows": template_img.convert("RGBa").resize(
+                (small_size[0], template_img.size[1]), Image.LANCZOS,
+                (0, 0) + template_img.size),
+            "small": template_img.resize(small_size, Image.LANCZOS)
+        }
+    return _scaled_templates[key]
+
+
+def get_inset_background(view_name):
+    # An inset view's template with the inset pasted on, minus the slogan
+    if view_name not in _inset_backgrounds:
+        inset = get_views()[view_name]["inset"]
+        small_img = get_scaled_template(inset["view"], inset["scale"])["small"]
+        background_img = get_template(get_views()[view_name]["template"])
+        background_img.paste(small_img, inset["xy"], small_img)
+        _inset_backgrounds[view_name] = background_img
+    return _inset_backgrounds[view_name]
+
+
+def resize_inset_region(view_name, scale, view_img, box):
+    # Scales `view_img`, a render of the slogan view `view_name`, down for
+    # the views showing it as an inset, where `box` is the part of it that
+    # differs from the template.  Only the small image's pixels that can
+    # see `box` are resampled, the same way `resize_region` does it, over
+    # the template's own rows everywhere else.  Returns them and their
+    # offset in the small image.
+    scaled = get_scaled_template(view_name, scale)
+    full_w, full_h = view_img.size
+    size = scaled["small"].size
+    scale_x = full_w / size[0]
+    scale_y = full_h / size[1]
+    left = max(0, int(box[0] / scale_x) - RESIZE_REACH)
+    top = max(0, int(box[1] / scale_y) - RESIZE_REACH)
+    right = min(size[0], int(ceil(box[2] / scale_x)) + RESIZE_REACH)
+    bottom = min(size[1], int(ceil(box[3] / scale_y)) + RESIZE_REACH)
+
+    # Rows: the changed rows at full width
+    band_h = box[3] - box[1]
+    band_img = view_img.crop((0, box[1], full_w, box[3])).convert("RGBa")
+    band_img = band_img.resize(
+        (size[0], band_h), Image.LANCZOS, (0, 0, full_w, band_h))
+
+    # Columns: the columns they reached, at full height
+    strip_img = scaled["rows"].crop((left, 0, right, full_h))
+    strip_img.paste(band_img.crop((left, 0, right, band_h)), (0, box[1]))
+    strip_img = strip_img.resize(
+        (right - left, size[1]), Image.LANCZOS, (0, 0, right - left, full_h))
+
+    resized_img = strip_img.crop((0, top, right - left, bottom))
+    return resized_img.convert("RGBA"), (left, top)
+
+
+def render_inset_view(view_name, region_img, region_xy):
+    # Copies the view's background and pastes the part of the inset the
+    # slogan changed, from `resize_inset_region`, over it.  That part is put
+    # back to the bare template first, so the inset's alpha is only applied
+    # once.
+    view = get_views()[view_name]
+    view_img = get_inset_background(view_name).copy()
+    if region_img is None:
+        return view_img
+    paste_xy = (
+        view["inset"]["xy"][0] + region_xy[0],
+        view["inset"]["xy"][1] + region_xy[1]
+    )
+    paste_box = paste_xy + (
+        paste_xy[0] + region_img.size[0], paste_xy[1] + region_img.size[1])
+    view_img.paste(get_template_master(view["template"]).crop(paste_box), paste_xy)
+    view_img.paste(region_img, paste_xy, region_img)
+    return view_img
+
+
+def get_encoder_profile(view, encoder_profiles=None):
+    # `encoder_profiles` maps views to `encoders.PROFILES` names
+    return (encoder_profiles or {}).get(view, encoders.DEFAULT_PROFILE)
+
+
+def get_render_paths(slogan, encoder_profiles=None):
+    return {
+        view_name: Path(
+            RENDER_PATH / f"{slogan['name']}_{view['suffix']}."
+            f"{encoders.PROFILES[get_encoder_profile(view_name, encoder_profiles)]['extension']}")  # noqa:E501
+        for view_name, view in get_views().items()
+    }
+
+
+def get_render_cache_key(slogan, legacy_warp, supersample=None,
+                         encoder_profiles=None):
+    # Everything the renders depend on, down to the bytes of the font and
+    # template files
+    font = get_font_spec(slogan["font"])
+    template_checksums = {
+        name: render_cache.file_checksum(path)
+        for name, path in get_registry()["templates"].items()
+    }
+    return render_cache.cache_key(
+        RENDER_VERSION,
+        slogan["wrapped"],
+        font["size"],
+        font["canvas"],
+        render_cache.file_checksum(font["path"]),
+        get_views(),
+        legacy_warp,
+        template_checksums,
+        # Left out at the defaults, so existing cache entries stay valid
+        *([supersample] if supersample else []),
+        *([encoder_profiles] if encoder_profiles else [])
+    )
+
+
+def get_layer_geometry(slogan, slogan_width, supersample=None):
+    # The canvas a slogan layer is drawn on, its scale, the size it's
+    # resized to and the filter it's resized with.  The size keeps the
+    # aspect of the font's own canvas, which is bigger for fonts that need
+    # a higher resolution, see the registry.
+    STARTING_W, STARTING_H = get_font_spec(slogan["font"])["canvas"]
+    slogan_resize = slogan_width / STARTING_W
+    size = (
+        int(ceil(STARTING_W * slogan_resize)),
+        int(ceil(STARTING_H * slogan_resize))
+    )
+    canvas_size, scale = get_render_canvas(slogan["font"], supersample, slogan_width)
+    # The slogan is drawn big enough that a box filter is as good
+    resample = Image.BOX if supersample else Image.LANCZOS
+    return canvas_size, scale, size, resample
+
+
+def has_niche(slogan, line):
+    # Whether the line holds the slogan's niche, e.g. the surname in "This
+    # Mug Belongs To Mr. Smith", as spelt in the input before cleaning
+    niche = slogan["niche"]
+    line = line.lower()
+    return bool(niche) and (niche in line or niche.replace("-", " ") in line)
+
+
+def render_pattern_layers(slogan, deflection, slogan_width, warp_cache_dir=None,
+                          supersample=None):
+    # Splits the slogan layer for catalogues generated from a few patterns
+    # with the niche filled in.  The lines without the niche are the same
+    # for every row of the pattern and are drawn, warped and resized once;
+    # each row only does the lines with its niche.  Returns the pattern's
+    # entry in `_pattern_layers` and the niche lines' layer, or None when
+    # the slogan can't be split: no line or every line has the niche, or
+    # the two parts come close enough to mix when resized.
+    canvas_size, scale, size, resample = get_layer_geometry(
+        slogan, slogan_width, supersample)
+    with timings.span("draw"):
+        placed_lines = place_slogan_lines(slogan, canvas_size, scale)
+    if placed_lines is None:
+        return None
+    fixed_lines = [placed for placed in placed_lines if not has_niche(slogan, placed[2])]  # noqa:E501
+    niche_lines = [placed for placed in placed_lines if has_niche(slogan, placed[2])]
+    if not fixed_lines or not niche_lines:
+        return None
+
+    font_size = get_slogan_font_size(slogan, scale)
+    warped_size = (
+        canvas_size[0],
+        get_warp_map(*canvas_size, deflection, warp_cache_dir).new_height
+    )
+    # Rows share the fixed part only where its lines are in the same places
+    key = (
+        slogan["font"], font_size, canvas_size, deflection, size, resample,
+        tuple((line, xy) for _, _, line, xy in fixed_lines)
+    )
+    pattern = _pattern_layers.get(key)
+    if pattern is None:
+        with timings.span("warp"):
+            fixed_warped = warp_placed_lines(
+                slogan["font"], font_size, fixed_lines, canvas_size, deflection,
+                warp_cache_dir)
+        with timings.span("resize"):
+            fixed_layer = resize_region(*fixed_warped, warped_size, size, resample)
+        pattern = {"warped": fixed_warped, "layer": fixed_layer, "bases": {}}
+        _pattern_layers[key] = pattern
+        if len(_pattern_layers) > PATTERN_CACHE_SIZE:
+            _pattern_layers.popitem(last=False)
+    _pattern_layers.move_to_end(key)
+
+    with timings.span("warp"):
+        niche_warped = warp_placed_lines(
+            slogan["font"], font_size, niche_lines, canvas_size, deflection,
+            warp_cache_dir)
+    if not regions_apart(pattern["warped"], niche_warped, warped_size, size):
+        return None
+    with timings.span("resize"):
+        niche_layer = resize_region(*niche_warped, warped_size, size, resample)
+    return pattern, niche_layer
+
+
+def get_pattern_base(pattern, view_name):
+    # The view's template with the pattern's fixed layer pasted on
+    if view_name not in pattern["bases"]:
+        view = get_views()[view_name]
+        fixed_img, fixed_offset = pattern["layer"]
+        base_img = get_template(view["template"])
+        base_img.paste(fixed_img, (
+            view["slogan_xy"][0] + fixed_offset[0],
+            view["slogan_xy"][1] + fixed_offset[1]
+        ), fixed_img)
+        pattern["bases"][view_name] = base_img
+    return pattern["bases"][view_name]
+
+
+def paste_box(img_size, paste_xy, layer_size):
+    # The part of an image of `img_size` that a layer pasted at `paste_xy`
+    # covers
+    return (
+        max(0, paste_xy[0]),
+        max(0, paste_xy[1]),
+        min(img_size[0], paste_xy[0] + layer_size[0]),
+        min(img_size[1], paste_xy[1] + layer_size[1])
+    )
+
+
+def render_slogan_layer(slogan, deflection, slogan_width, legacy_warp=False,
+                        warp_cache_dir=None, supersample=None):
+    # The slogan drawn, warped and scaled to `slogan_width`.  Returns the
+    # image and its offset from where the layer is pasted.
+    canvas_size, scale, size, resample = get_layer_geometry(
+        slogan, slogan_width, supersample)
+
+    if legacy_warp:
+        with timings.span("draw"):
+            slogan_img = draw_slogan(slogan, *canvas_size, scale)
+        with timings.span("warp"):
+            transformed_img = transform_slogan_legacy(slogan_img, deflection)
+        with timings.span("resize"):
+            transformed_img = transformed_img.resize(size, resample)
+        return transformed_img, (0, 0)
+
+    # Only the box around the text is drawn, warped and resized; the rest
+    # of the canvas is transparent and would not change the mugs.  Lines
+    # are warped one by one where they can be, which gives the same pixels
+    # as warping them together.
+    with timings.span("draw"):
+        placed_lines = place_slogan_lines(slogan, canvas_size, scale)
+        if placed_lines is None:
+            slogan_img, (left, top) = draw_slogan_region(slogan, *canvas_size, scale)
+    with timings.span("warp"):
+        if placed_lines is not None:
+            transformed_img, (left, transformed_top) = warp_placed_lines(
+                slogan["font"], get_slogan_font_size(slogan, scale), placed_lines,
+                canvas_size, deflection, warp_cache_dir)
+        else:
+            transformed_img, transformed_top = transform_region(
+                slogan_img, left, top, canvas_size, deflection, warp_cache_dir)
+    warped_size = (
+        canvas_size[0],
+        get_warp_map(*canvas_size, deflection, warp_cache_dir).new_height
+    )
+    with timings.span("resize"):
+        return resize_region(
+            transformed_img, (left, transformed_top), warped_size, size, resample)
+
+
+def render_slogan(slogan, legacy_warp=False, warp_cache_dir=None,
+                  render_cache_dir=None, in_memory=False, supersample=None,
+                  encoder_profiles=None, templated=False):
+    # Saves a render per view in the registry to render/ and sets the
+    # slogan's `*_path` fields or, `in_memory`, sets its `*_bytes` fields to
+    # the encoded images.  `encoder_profiles` picks the format per view, PNG by default.
+    # `supersample` draws and warps the slogan at 1, 2 or 4 times its final
+    # width and scales it down with a box filter; by default it's done on
+    # the font's canvas and scaled down with Lanczos.  `templated` reuses
+    # the part of the slogan without the niche from earlier rows of the same
+    # pattern, see `render_pattern_layers`; the renders come out the same.
+    if all(f"{view}_url" in slogan for view in get_views()):
+        # Uploaded by an earlier run, see `journal.resume_slogans`
+        return slogan
+
+    render_paths = get_render_paths(slogan, encoder_profiles)
+    if render_cache_dir:
+        cache_key = get_render_cache_key(
+            slogan, legacy_warp, supersample, encoder_profiles)
+        if in_memory:
+            view_bytes = render_cache.fetch_bytes(
+                render_cache_dir, cache_key, get_views())
+            if view_bytes:
+                for view, image_bytes in view_bytes.items():
+                    slogan[f"{view}_bytes"] = image_bytes
+                return slogan
+        elif render_cache.fetch(render_cache_dir, cache_key, render_paths):
+            for view, render_path in render_paths.items():
+                slogan[f"{view}_path"] = render_path
+            return slogan
+
+    # Views are composited in registry order, so inset views find the view
+    # they show already done.  Views that need the same warped slogan, or
+    # the same scaled inset, share it.
+    layers = {}
+    insets = {}
+    mug_imgs = {}
+    slogan_boxes = {}
+    for view_name, view in get_views().items():
+        if "inset" in view:
+            inset_key = (view["inset"]["view"], view["inset"]["scale"])
+            with timings.span("composite"):
+                if inset_key not in insets:
+                    slogan_box = slogan_boxes[inset_key[0]]
+                    if slogan_box[0] < slogan_box[2] and slogan_box[1] < slogan_box[3]:
+                        insets[inset_key] = resize_inset_region(
+                            *inset_key, mug_imgs[inset_key[0]], slogan_box)
+                    else:
+                        insets[inset_key] = (None, None)
+                mug_imgs[view_name] = render_inset_view(view_name, *insets[inset_key])
+            continue
+
+        layer_key = (
+            view.get("deflection", DEFLECTION), view.get("slogan_width", FINAL_W))
+        if layer_key not in layers:
+            pattern_layers = None
+            if templated and not legacy_warp:
+                pattern_layers = render_pattern_layers(
+                    slogan, *layer_key, warp_cache_dir, supersample)
+            if pattern_layers is None:
+                pattern_layers = None, render_slogan_layer(
+                    slogan, *layer_key, legacy_warp, warp_cache_dir, supersample)
+            layers[layer_key] = pattern_layers
+        pattern, (layer_img, layer_offset) = layers[layer_key]
+
+        paste_xy = (
+            view["slogan_xy"][0] + layer_offset[0],
+            view["slogan_xy"][1] + layer_offset[1]
+        )
+        with timings.span("composite"):
+            if pattern is None:
+                mug_img = get_template(view["template"])
             else:
-                STARTING_W, STARTING_H = 1634, 1700
-            slogan_img = draw_slogan(MAX_W=STARTING_W, MAX_H=STARTING_H)
-            transformed_img = transform_slogan(slogan_img)
-
-            # Calculate the resize by figuring out the final size.
-            FINAL_W = 1372
-            slogan_resize = FINAL_W / STARTING_W
-            size = (
-                int(ceil(STARTING_W * slogan_resize)),
-                int(ceil(STARTING_H * slogan_resize))
-            )
-            transformed_img = transformed_img.resize(size, Image.ANTIALIAS)
-
-            # paste onto left_mug_img
-            left_mug_img = Image.open(Path("resources/mug_left_large.png"))
-            left_mug_img.paste(transformed_img, (600, 180), transformed_img)
-
-            # paste onto right_mug_img
-            right_mug_img = Image.open(Path("resources/mug_right_large.png"))
-            right_mug_img.paste(transformed_img, (-20, 180), transformed_img)
-
-            # resize left_mug_image
-            mug_resize = 0.5
-            new_mug_w = int(ceil(left_mug_img.size[0] * mug_resize))
-            new_mug_h = int(ceil(left_mug_img.size[1] * mug_resize))
-            new_mug_size = (new_mug_w, new_mug_h)
-            small_mug_img = left_mug_img.copy().resize((new_mug_size), Image.ANTIALIAS)
-
-            # paste onto microwave_mug_img
-            microwave_mug_img = Image.open(Path("resources/microwave_mug.png"))
-            microwave_mug_img.paste(small_mug_img, (440, 45), small_mug_img)
-
-            # paste onto size_example_img
-            size_example_img = Image.open(Path("resources/size_example.png"))
-            size_example_img.paste(small_mug_img, (440, 45), small_mug_img)
-
-            # save
-            render_path = Path(f"render/")
-            Path(render_path).mkdir(parents=True, exist_ok=True)
-
-            left_mug_path = Path(render_path / f"{slogan['name']}_left.png")
-            left_mug_img.save(left_mug_path)
-            slogan["left_mug_path"] = left_mug_path
-
-            right_mug_path = Path(render_path / f"{slogan['name']}_right.png")
-            right_mug_img.save(right_mug_path)
-            slogan["right_mug_path"] = right_mug_path
-
-            microwave_mug_path = Path(
-                render_path / f"{slogan['name']}_microwave_mug.png")
-            microwave_mug_img.save(microwave_mug_path)
-            slogan["microwave_mug_path"] = microwave_mug_path
-
-            size_example_path = Path(render_path / f"{slogan['name']}_size_example.png")
-            size_example_img.save(size_example_path)
-            slogan["size_example_path"] = size_example_path
-
-            slogans_with_path.append(slogan)
-        except Exception as e:
-            error_msg = f"{e}. {slogan['slogan']}"
+                # The template with the fixed part already on
+                mug_img = get_pattern_base(pattern, view_name).copy()
+            mug_img.paste(layer_img, paste_xy, layer_img)
+        mug_imgs[view_name] = mug_img
+        # The part of the render that differs from the template
+        boxes = [paste_box(mug_img.size, paste_xy, layer_img.size)]
+        if pattern is not None:
+            fixed_img, fixed_offset = pattern["layer"]
+            boxes.append(paste_box(mug_img.size, (
+                view["slogan_xy"][0] + fixed_offset[0],
+                view["slogan_xy"][1] + fixed_offset[1]
+            ), fixed_img.size))
+            boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+        slogan_boxes[view_name] = (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes)
+        ) if boxes else (0, 0, 0, 0)
+
+    if in_memory:
+        view_bytes = {}
+        for view, mug_img in mug_imgs.items():
+            with timings.span("encode"):
+                view_bytes[view] = encoders.encode_image(
+                    mug_img, get_encoder_profile(view, encoder_profiles))
+            slogan[f"{view}_bytes"] = view_bytes[view]
+        if render_cache_dir:
+            render_cache.store_bytes(render_cache_dir, cache_key, view_bytes)
+        return slogan
+
+    for view, mug_img in mug_imgs.items():
+        # The path may be a hard link into the render cache, see
+        # `render_cache.fetch`; saving would write through it
+        if os.path.lexists(render_paths[view]):
+            os.unlink(render_paths[view])
+        with timings.span("encode"):
+            encoders.save_image(
+                mug_img, render_paths[view],
+                get_encoder_profile(view, encoder_profiles))
+        slogan[f"{view}_path"] = render_paths[view]
+
+    if render_cache_dir:
+        render_cache.store(render_cache_dir, cache_key, render_paths)
+
+    return slogan
+
+
+def render_slogan_in_worker(slogan):
+    # Errors are handed back rather than logged here, so they end up in
+    # mugup.log no matter how the worker process was started
+    try:
+        return render_slogan(slogan, **_render_options), None
+    except Exception as e:
+        return slogan, f"{e}. {slogan['slogan']}"
+
+
+def _render_slogan_in_pool(slogan):
+    # The worker's timing samples go back to the main process with the render
+    return render_slogan_in_worker(slogan), timings.take_samples()
+
+
+def skip_failed(results):
+    # Logs the errors of a (slogan, error_msg) stream and passes on the rest
+    for slogan, error_msg in results:
+        if error_msg:
             logging.error(error_msg)
             continue
+        yield slogan
 
-    return slogans_with_path
 
+def render_slogans(slogans, legacy_warp=False, warp_cache_dir=None, workers=1,
+                   render_cache_dir=None,
+                   render_cache_max_mb=render_cache.DEFAULT_MAX_MB, chunksize=1,
+                   in_memory=False, supersample=None, encoder_profiles=None,
+                   templated=False):
+    # Yields (slogan, error_msg) in input order, error_msg being None on
+    # success.  `slogans` can be any iterable, e.g. a generator over the
+    # input file: with workers only a few chunks per worker are read ahead.
+    render_options = {
+        "legacy_warp": legacy_warp,
+        "warp_cache_dir": warp_cache_dir,
+        "render_cache_dir": render_cache_dir,
+        "in_memory": in_memory,
+        "supersample": supersample,
+        "encoder_profiles": encoder_profiles,
+        "templated": templated,
+        # Workers use the registry as checked at startup
+        "registry": get_registry(),
+        "timings": timings.is_enabled()
+    }
+    RENDER_PATH.mkdir(parents=True, exist_ok=True)
 
-def upload_mugs_to_s3(rendered_slogan_dicts):
-    print("Upload mug renders to S3")
-    AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID", "")
-    AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY", "")
-    bucket = "giftsondemand"
-    today_str = str(date.today())
+    try:
+        if workers > 1:
+            # Decode the templates once here; the workers map the raw dumps
+            render_options["template_manifest"] = dump_templates(
+                RENDER_PATH / ".templates")
+            yield from _render_slogans_in_pool(
+                slogans, render_options, workers, chunksize)
+        else:
+            init_render_worker(render_options)
+            for slogan in slogans:
+                yield render_slogan_in_worker(slogan)
+    finally:
+        if render_cache_dir:
+            evicted = render_cache.evict(
+                render_cache_dir, render_cache_max_mb * 1024 * 1024)
+            if evicted:
+                logging.info(f"Evicted {evicted} renders from the render cache")
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
 
-    slogans_with_mug_urls = []
-    for slogan in progressbar(rendered_slogan_dicts):
+def _render_slogans_in_pool(slogans, render_options, workers, chunksize):
+    # `imap` would otherwise read all of `slogans` up front.  Every slogan
+    # handed to the pool takes a slot, freed when its render is collected.
+    free_slots = Semaphore(workers * chunksize * 4)
+    stopping = Event()
+
+    def throttled_slogans():
+        for slogan in slogans:
+            free_slots.acquire()
+            if stopping.is_set():
+                return
+            yield slogan
+
+    with Pool(workers, init_render_worker, (render_options,)) as pool:
         try:
-            images_to_upload_paths = {
-                "left_mug": slogan["left_mug_path"],
-                "right_mug": slogan["right_mug_path"],
-                "microwave_mug": slogan["microwave_mug_path"],
-                "size_example": slogan["size_example_path"]
-            }
-            for key, local_img_path in images_to_upload_paths.items():
-                s3_img_path = f"{today_str}/{local_img_path.name}"
-                with open(local_img_path, "rb") as f:
-                    s3.put_object(
-                        Bucket=bucket,
-                        Key=s3_img_path,
-                        Body=f,
-                        ContentType="image/png",
-                        ACL="public-read"
-                    )
-                # Example finished AWS S3 URL
-                # https://giftsondemand.s3.amazonaws.com/2020-01-07/10_r.png
-                aws_url = f"https://{bucket}.s3.amazonaws.com/{s3_img_path}"
-                slogan[f"{key}_url"] = aws_url
-            slogans_with_mug_urls.append(slogan)
-        except Exception as e:
-            full_error_message = f"{e}. Problem with {slogan['slogan']}"
-            logging.error(full_error_message)
-            continue
+            # `imap` hands the results back in input order
+            for result, samples in pool.imap(
+                    _render_slogan_in_pool, throttled_slogans(), chunksize):
+                free_slots.release()
+                timings.add_samples(samples)
+                yield result
+        finally:
+            # Unblock the pool's feeder thread if we stop early
+            stopping.set()
+            free_slots.release()
+
+
+def render_mugs(valid_slogan_dicts, legacy_warp=False, warp_cache_dir=None,
+                workers=1, render_cache_dir=None,
+                render_cache_max_mb=render_cache.DEFAULT_MAX_MB, supersample=None,
+                encoder_profiles=None, templated=False):
+    print("Create mug render images")
+    # Small chunks keep the workers evenly loaded
+    chunksize = max(1, len(valid_slogan_dicts) // (workers * 4))
+    results = render_slogans(
+        valid_slogan_dicts,
+        legacy_warp=legacy_warp,
+        warp_cache_dir=warp_cache_dir,
+        workers=workers,
+        render_cache_dir=render_cache_dir,
+        render_cache_max_mb=render_cache_max_mb,
+        chunksize=chunksize,
+        supersample=supersample,
+        encoder_profiles=encoder_profiles,
+        templated=templated
+    )
+
+    return list(skip_failed(progressbar(results, max_value=len(valid_slogan_dicts))))
+
+
+def upload_slogans(rendered_slogans, concurrency=s3_upload.DEFAULT_CONCURRENCY,
+                   endpoint_url=None, encoder_profiles=None, manifest_path=None,
+                   content_keys=False):
+    # Yields (slogan, error_msg) in input order, with the slogan's `*_url`
+    # fields set on success.  Pulls from `rendered_slogans` only as fast as
+    # the uploads keep up.  `encoder_profiles` must be what they were
+    # rendered with.  With `manifest_path`, images the bucket already has
+    # aren't uploaded again.  With `content_keys`, images are named after
+    # their content instead of going under today's date, so an unchanged
+    # one keeps its URL from day to day.
+    bucket = s3_upload.BUCKET
+    today_str = str(date.today())
+
+    s3 = s3_upload.make_s3_client(concurrency, endpoint_url)
+    manifest = None
+    if manifest_path is not None:
+        manifest = s3_upload.open_upload_manifest(manifest_path)
+        if not content_keys:
+            try:
+                s3_upload.list_checksums(s3, bucket, f"{today_str}/", manifest)
+            except Exception as e:
+                # Falls back to a HEAD per image
+                logging.error(f"Could not list {bucket}/{today_str}/: {e}")
+
+    def upload_groups():
+        for slogan in rendered_slogans:
+            if all(f"{view}_url" in slogan for view in get_views()):
+                # Uploaded by an earlier run
+                yield (slogan, {}, None), []
+                continue
+            try:
+                # In-memory renders go up straight from their bytes
+                s3_img_paths = {}
+                uploads = []
+                for view, render_path in get_render_paths(
+                        slogan, encoder_profiles).items():
+                    source = slogan.get(f"{view}_bytes") or slogan[f"{view}_path"]
+                    if content_keys:
+                        s3_img_path = s3_upload.content_key(
+                            source, render_path.suffix[1:])
+                    else:
+                        s3_img_path = f"{today_str}/{render_path.name}"
+                    s3_img_paths[view] = s3_img_path
+                    uploads.append((
+                        s3_img_path,
+                        source,
+                        encoders.PROFILES[
+                            get_encoder_profile(view, encoder_profiles)]["content_type"]
+                    ))
+                yield (slogan, s3_img_paths, None), uploads
+            except Exception as e:
+                yield (slogan, {}, e), []
 
-    rmtree(Path(f"render/"))
+    results = s3_upload.upload_groups(
+        s3, bucket, upload_groups(), concurrency, manifest=manifest)
+    try:
+        for (slogan, s3_img_paths, error), upload_error in results:
+            error = error or upload_error
+            if error:
+                yield slogan, f"{error}. Problem with {slogan['slogan']}"
+                continue
+            for key, s3_img_path in s3_img_paths.items():
+                slogan[f"{key}_url"] = s3_upload.object_url(
+                    bucket, s3_img_path, endpoint_url)
+                # Done with the encoded image; don't hold it for the listing
+                slogan.pop(f"{key}_bytes", None)
+            yield slogan, None
+    finally:
+        if manifest is not None:
+            manifest.file.close()
+            logging.info(
+                f"Uploaded {manifest.counts['uploaded']} images, skipped "
+                f"{manifest.counts['skipped']} the bucket already had")
+
+
+def upload_mugs_to_s3(rendered_slogan_dicts,
+                      concurrency=s3_upload.DEFAULT_CONCURRENCY,
+                      endpoint_url=None, encoder_profiles=None, manifest_path=None,
+                      content_keys=False):
+    print("Upload mug renders to S3")
+    results = upload_slogans(
+        rendered_slogan_dicts, concurrency, endpoint_url, encoder_profiles,
+        manifest_path, content_keys)
+
+    slogans_with_mug_urls = list(
+        skip_failed(progressbar(results, max_value=len(rendered_slogan_dicts))))
+
+    rmtree(RENDER_PATH, ignore_errors=True)
 
     return slogans_with_mug_urls
 
 
-def create_amazon_upload_file(uploaded_mugs_dicts):
-    print("Format dict for csv printing")
-    formatted_dicts = []
+def format_amazon_row(i, slogan_dict, today_str):
+    image_urls = [slogan_dict[f"{view}_url"] for view in get_views()]
+    return amazon_listing.format_row(
+        f"{today_str}-{i}", slogan_dict["item_name"], slogan_dict["keywords"],
+        image_urls)
+
+
+def create_amazon_upload_file(uploaded_mugs_dicts, first_sku=0, on_listed=None,
+                              max_rows=amazon_listing.DEFAULT_MAX_ROWS):
+    # `uploaded_mugs_dicts` can be a stream: each listing row is written as
+    # soon as its slogan arrives, into a new file every `max_rows` rows.
+    # SKUs are numbered from `first_sku`; `on_listed(slogan)` is called once
+    # a slogan's row is on disk.
     today_str = date.today().strftime("%Y%m%d")
 
-    for i, slogan_dict in progressbar(enumerate(uploaded_mugs_dicts)):
-        try:
-            formatted_dict = {}
-            formatted_dict["feed_product_type"] = "kitchen"
-            formatted_dict["item_sku"] = f"{today_str}-{i}"
-            formatted_dict["brand_name"] = "Gifts On Demand"
-            formatted_dict["item_name"] = slogan_dict["item_name"]
-            formatted_dict["external_product_id"] = ""
-            formatted_dict["external_product_id_type"] = "UPC"
-            formatted_dict["item_type"] = "novelty-coffee-mugs"
-            formatted_dict["standard_price"] = 19.95
-            formatted_dict["quantity"] = 99
-            formatted_dict["main-image-url"] = slogan_dict["left_mug_url"]
-            formatted_dict["other-image-url1"] = slogan_dict["right_mug_url"]
-            formatted_dict["other-image-url2"] = slogan_dict["microwave_mug_url"]
-            formatted_dict["other-image-url3"] = slogan_dict["size_example_url"]
-            formatted_dict["other-image-url4"] = ""
-            formatted_dict["other-image-url5"] = ""
-            formatted_dict["other-image-url6"] = ""
-            formatted_dict["other-image-url7"] = ""
-            formatted_dict["other-image-url8"] = ""
-            formatted_dict["swatch-image-url"] = ""
-            formatted_dict["parent_child"] = ""
-            formatted_dict["parent_sku"] = ""
-            formatted_dict["relationship_type"] = ""
-            formatted_dict["variation_theme"] = ""
-            formatted_dict["update_delete"] = ""
-            formatted_dict["product_description"] = ""
-            formatted_dict["manufacturer"] = ""
-            formatted_dict["part_number"] = ""
-            formatted_dict["model"] = ""
-            formatted_dict["closure_type"] = ""
-            formatted_dict["bullet_point1"] = "High quality mug makes the perfect gift for everyone."  # noqa:E501
-            formatted_dict["bullet_point2"] = "Printed on only the highest quality mugs. The print will never fade no matter how many times it is washed."  # noqa:E501
-            formatted_dict["bullet_point3"] = "Packaged, and shipped from the USA."
-            formatted_dict["bullet_point4"] = "Dishwasher and Microwave safe."
-            formatted_dict["bullet_point5"] = "Shipped in a custom made styrofoam package to ensure it arrives perfect. GUARANTEED."  # noqa:E501
-            formatted_dict["target_audience_base"] = ""
-            formatted_dict["catalog_number"] = ""
-            formatted_dict["specific_uses_keywords1"] = ""
-            formatted_dict["specific_uses_keywords2"] = ""
-            formatted_dict["specific_uses_keywords3"] = ""
-            formatted_dict["specific_uses_keywords4"] = ""
-            formatted_dict["specific_uses_keywords5"] = ""
-            formatted_dict["target_audience_keywords1"] = ""
-            formatted_dict["target_audience_keywords2"] = ""
-            formatted_dict["target_audience_keywords3"] = ""
-            formatted_dict["thesaurus_attribute_keywords1"] = ""
-            formatted_dict["thesaurus_attribute_keywords2"] = ""
-            formatted_dict["thesaurus_attribute_keywords3"] = ""
-            formatted_dict["thesaurus_attribute_keywords4"] = ""
-            formatted_dict["thesaurus_subject_keywords1"] = ""
-            formatted_dict["thesaurus_subject_keywords2"] = ""
-            formatted_dict["thesaurus_subject_keywords3"] = ""
-            formatted_dict["generic_keywords"] = slogan_dict["keywords"]
-            formatted_dict["platinum_keywords1"] = ""
-            formatted_dict["platinum_keywords2"] = ""
-            formatted_dict["platinum_keywords3"] = ""
-            formatted_dict["platinum_keywords4"] = ""
-            formatted_dict["platinum_keywords5"] = ""
-            formatted_dict["country_as_labeled"] = ""
-            formatted_dict["fur_description"] = ""
-            formatted_dict["occasion"] = ""
-            formatted_dict["number_of_pieces"] = ""
-            formatted_dict["scent_name"] = ""
-            formatted_dict["included_components"] = ""
-            formatted_dict["color_name"] = "white"
-            formatted_dict["color_map"] = ""
-            formatted_dict["size_name"] = ""
-            formatted_dict["material_type"] = ""
-            formatted_dict["style_name"] = ""
-            formatted_dict["power_source_type"] = ""
-            formatted_dict["wattage"] = ""
-            formatted_dict["special_features1"] = ""
-            formatted_dict["special_features2"] = ""
-            formatted_dict["special_features3"] = ""
-            formatted_dict["special_features4"] = ""
-            formatted_dict["special_features5"] = ""
-            formatted_dict["pattern_name"] = ""
-            formatted_dict["lithium_battery_voltage"] = ""
-            formatted_dict["compatible_devices1"] = ""
-            formatted_dict["compatible_devices2"] = ""
-            formatted_dict["compatible_devices3"] = ""
-            formatted_dict["compatible_devices4"] = ""
-            formatted_dict["compatible_devices5"] = ""
-            formatted_dict["compatible_devices6"] = ""
-            formatted_dict["compatible_devices7"] = ""
-            formatted_dict["compatible_devices8"] = ""
-            formatted_dict["compatible_devices9"] = ""
-            formatted_dict["compatible_devices10"] = ""
-            formatted_dict["wattage_unit_of_measure"] = ""
-            formatted_dict["included_features"] = ""
-            formatted_dict["lithium_battery_voltage_unit_of_measure"] = ""
-            formatted_dict["length_range"] = ""
-            formatted_dict["shaft_style_type"] = ""
-            formatted_dict["specification_met"] = ""
-            formatted_dict["breed_recommendation"] = ""
-            formatted_dict["directions"] = ""
-            formatted_dict["number_of_sets"] = ""
-            formatted_dict["blade_edge_type"] = ""
-            formatted_dict["blade_material_type"] = ""
-            formatted_dict["material_composition"] = ""
-            formatted_dict["mfg_maximum"] = ""
-            formatted_dict["mfg_minimum"] = ""
-            formatted_dict["website_shipping_weight"] = ""
-            formatted_dict["website_shipping_weight_unit_of_measure"] = ""
-            formatted_dict["item_shape"] = ""
-            formatted_dict["item_display_length_unit_of_measure"] = ""
-            formatted_dict["item_display_width_unit_of_measure"] = ""
-            formatted_dict["item_display_height_unit_of_measure"] = ""
-            formatted_dict["item_display_length"] = ""
-            formatted_dict["item_display_width"] = ""
-            formatted_dict["item_display_depth"] = ""
-            formatted_dict["item_display_height"] = ""
-            formatted_dict["item_display_diameter"] = ""
-            formatted_dict["item_display_weight"] = ""
-            formatted_dict["item_display_weight_unit_of_measure"] = ""
-            formatted_dict["volume_capacity_name"] = 11
-            formatted_dict["volume_capacity_name_unit_of_measure"] = "ounces"
-            formatted_dict["item_height"] = ""
-            formatted_dict["item_length"] = ""
-            formatted_dict["item_width"] = ""
-            formatted_dict["size_map"] = ""
-            formatted_dict["weight_recommendation_unit_of_measure"] = ""
-            formatted_dict["width_range"] = ""
-            formatted_dict["maximum_weight_recommendation"] = ""
-            formatted_dict["item_dimensions_unit_of_measure"] = ""
-            formatted_dict["fulfillment_center_id"] = ""
-            formatted_dict["package_height"] = ""
-            formatted_dict["package_width"] = ""
-            formatted_dict["package_length"] = ""
-            formatted_dict["package_dimensions_unit_of_measure"] = ""
-            formatted_dict["package_weight"] = ""
-            formatted_dict["package_weight_unit_of_measure"] = ""
-            formatted_dict["energy_efficiency_image_url"] = ""
-            formatted_dict["warranty_description"] = ""
-            formatted_dict["cpsia_cautionary_statement"] = ""
-            formatted_dict["cpsia_cautionary_description"] = ""
-            formatted_dict["fabric_type"] = ""
-            formatted_dict["import_designation"] = ""
-            formatted_dict["legal_compliance_certification_metadata"] = ""
-            formatted_dict["legal_compliance_certification_expiration_date"] = ""
-            formatted_dict["item_volume"] = ""
-            formatted_dict["item_volume_unit_of_measure"] = ""
-            formatted_dict["specific_uses_for_product"] = ""
-            formatted_dict["country_string"] = ""
-            formatted_dict["country_of_origin"] = ""
-            formatted_dict["legal_disclaimer_description"] = ""
-            formatted_dict["usda_hardiness_zone1"] = ""
-            formatted_dict["usda_hardiness_zone2"] = ""
-            formatted_dict["are_batteries_included"] = ""
-            formatted_dict["item_weight"] = ""
-            formatted_dict["batteries_required"] = ""
-            formatted_dict["battery_type1"] = ""
-            formatted_dict["battery_type2"] = ""
-            formatted_dict["battery_type3"] = ""
-            formatted_dict["item_weight_unit_of_measure"] = ""
-            formatted_dict["number_of_batteries1"] = ""
-            formatted_dict["number_of_batteries2"] = ""
-            formatted_dict["number_of_batteries3"] = ""
-            formatted_dict["lithium_battery_energy_content"] = ""
-            formatted_dict["lithium_battery_packaging"] = ""
-            formatted_dict["lithium_battery_weight"] = ""
-            formatted_dict["number_of_lithium_ion_cells"] = ""
-            formatted_dict["number_of_lithium_metal_cells"] = ""
-            formatted_dict["battery_cell_composition"] = ""
-            formatted_dict["battery_weight"] = ""
-            formatted_dict["battery_weight_unit_of_measure"] = ""
-            formatted_dict["lithium_battery_energy_content_unit_of_measure"] = ""
-            formatted_dict["lithium_battery_weight_unit_of_measure"] = ""
-            formatted_dict["supplier_declared_dg_hz_regulation1"] = ""
-            formatted_dict["supplier_declared_dg_hz_regulation2"] = ""
-            formatted_dict["supplier_declared_dg_hz_regulation3"] = ""
-            formatted_dict["supplier_declared_dg_hz_regulation4"] = ""
-            formatted_dict["supplier_declared_dg_hz_regulation5"] = ""
-            formatted_dict["hazmat_united_nations_regulatory_id"] = ""
-            formatted_dict["safety_data_sheet_url"] = ""
-            formatted_dict["lighting_facts_image_url"] = ""
-            formatted_dict["flash_point"] = ""
-            formatted_dict["external_testing_certification1"] = ""
-            formatted_dict["external_testing_certification2"] = ""
-            formatted_dict["external_testing_certification3"] = ""
-            formatted_dict["external_testing_certification4"] = ""
-            formatted_dict["external_testing_certification5"] = ""
-            formatted_dict["external_testing_certification6"] = ""
-            formatted_dict["ghs_classification_class1"] = ""
-            formatted_dict["ghs_classification_class2"] = ""
-            formatted_dict["ghs_classification_class3"] = ""
-            formatted_dict["california_proposition_65_compliance_type"] = ""
-            formatted_dict["california_proposition_65_chemical_names1"] = ""
-            formatted_dict["california_proposition_65_chemical_names2"] = ""
-            formatted_dict["california_proposition_65_chemical_names3"] = ""
-            formatted_dict["california_proposition_65_chemical_names4"] = ""
-            formatted_dict["california_proposition_65_chemical_names5"] = ""
-            formatted_dict["merchant_shipping_group_name"] = ""
-            formatted_dict["list_price"] = ""
-            formatted_dict["map_price"] = ""
-            formatted_dict["product_site_launch_date"] = ""
-            formatted_dict["merchant_release_date"] = ""
-            formatted_dict["condition_type"] = ""
-            formatted_dict["restock_date"] = ""
-            formatted_dict["fulfillment_latency"] = ""
-            formatted_dict["condition_note"] = ""
-            formatted_dict["product_tax_code"] = ""
-            formatted_dict["sale_price"] = ""
-            formatted_dict["sale_from_date"] = ""
-            formatted_dict["sale_end_date"] = ""
-            formatted_dict["item_package_quantity"] = ""
-            formatted_dict["max_aggregate_ship_quantity"] = ""
-            formatted_dict["offering_can_be_gift_messaged"] = ""
-            formatted_dict["offering_can_be_giftwrapped"] = ""
-            formatted_dict["is_discontinued_by_manufacturer"] = ""
-            formatted_dict["max_order_quantity"] = ""
-            formatted_dict["number_of_items"] = ""
-            formatted_dict["offering_start_date"] = ""
-            formatted_dict["offering_end_date"] = ""
-
-            formatted_dicts.append(formatted_dict)
-        except Exception as e:
-            error_msg = f"{e}. {slogan_dict['slogan']}"
-            logging.error(error_msg)
+    def listing_rows():
+        for i, slogan_dict in progressbar(enumerate(uploaded_mugs_dicts, first_sku)):
+            # Timed until the row is written and recorded
+            with timings.span("listing"):
+                try:
+                    row = format_amazon_row(i, slogan_dict, today_str)
+                except Exception as e:
+                    error_msg = f"{e}. {slogan_dict['slogan']}"
+                    logging.error(error_msg)
+                    continue
+                yield row, slogan_dict
 
-    print("Write listing information to txt file")
-    amazon_data = [
-        [
-            "TemplateType=fptcustom",
-            "Version=2020.0324",
-            "TemplateSignature=S0lUQ0hFTg==",
-            "The top 3 rows are for Amazon.com use only. Do not modify or delete the top 3 rows.",  # noqa:E501
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Images",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Variation",
-            "",
-            "",
-            "",
-            "Basic",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Discovery",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Product Enrichment",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Dimensions",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Fulfillment",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Compliance",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Offer",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            ""
-        ],
-        [
-            "Product Type",
-            "Seller SKU",
-            "Brand Name",
-            "Product Name",
-            "Product ID",
-            "Product ID Type",
-            "Item Type Keyword",
-            "Standard Price",
-            "Quantity",
-            "Main Image URL",
-            "Other Image URL1",
-            "Other Image URL2",
-            "Other Image URL3",
-            "Other Image URL4",
-            "Other Image URL5",
-            "Other Image URL6",
-            "Other Image URL7",
-            "Other Image URL8",
-            "Swatch Image URL",
-            "Parentage",
-            "Parent SKU",
-            "Relationship Type",
-            "Variation Theme",
-            "Update Delete",
-            "Product Description",
-            "Manufacturer",
-            "Manufacturer Part Number",
-            "model",
-            "closure_type",
-            "Key Product Features",
-            "Key Product Features",
-            "Key Product Features",
-            "Key Product Features",
-            "Key Product Features",
-            "Target Audience",
-            "Catalog Number",
-            "Used For1 - Used For3",
-            "Used For1 - Used For3",
-            "Used For1 - Used For3",
-            "Used For1 - Used For3",
-            "Used For1 - Used For3",
-            "Target Audience",
-            "Target Audience",
-            "Target Audience",
-            "Other Attributes",
-            "Other Attributes",
-            "Other Attributes",
-            "Other Attributes",
-            "Subject Matter",
-            "Subject Matter",
-            "Subject Matter",
-            "Search Terms",
-            "Platinum Keywords",
-            "Platinum Keywords",
-            "Platinum Keywords",
-            "Platinum Keywords",
-            "Platinum Keywords",
-            "Country/Region as Labeled",
-            "Fur Description",
-            "Occasion",
-            "Number of Pieces",
-            "Scent",
-            "Included Components",
-            "Color",
-            "Color Map",
-            "Size",
-            "Material Type",
-            "Style Name",
-            "Power Source",
-            "Wattage",
-            "Additional Features",
-            "Additional Features",
-            "Additional Features",
-            "Additional Features",
-            "Additional Features",
-            "Pattern",
-            "Lithium Battery Voltage",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Compatible Devices",
-            "Wattage Unit of Measure",
-            "included_features",
-            "Lithium Battery Voltage Unit of Measure",
-            "Length Range",
-            "shaft_style_type",
-            "Specification Met",
-            "breed_recommendation",
-            "directions",
-            "Number of Sets",
-            "Blade Type",
-            "Blade Material Type",
-            "Material Composition",
-            "Maximum Age Recommendation",
-            "Minimum Age Recommendation",
-            "Shipping Weight",
-            "Website Shipping Weight Unit Of Measure",
-            "Shape",
-            "Display Length Unit Of Measure",
-            "Item Display Width Unit Of Measure",
-            "Item Display Height Unit Of Measure",
-            "Item Display Length",
-            "Item Display Width",
-            "Item Display Depth",
-            "Item Display Height",
-            "Item Display Diameter",
-            "Item Display Weight",
-            "Item Display Weight Unit Of Measure",
-            "Volume",
-            "Volume Capacity Name Unit Of Measure",
-            "Item Height",
-            "Item Length",
-            "Item Width",
-            "Size Map",
-            "Weight Recommendation Unit Of Measure",
-            "Width Range",
-            "maximum_weight_recommendation",
-            "Item Dimensions Unit Of Measure",
-            "Fulfillment Center ID",
-            "Package Height",
-            "Package Width",
-            "Package Length",
-            "Package Dimensions Unit Of Measure",
-            "Package Weight",
-            "Package Weight Unit Of Measure",
-            "Energy Guide Label",
-            "Manufacturer Warranty Description",
-            "Cpsia Warning",
-            "CPSIA Warning Description",
-            "Fabric Type",
-            "Import Designation",
-            "Please provide the Executive Number (EO) required for sale into California.",  # noqa:E501
-            "Please provide the expiration date of the EO Number.",
-            "Volume",
-            "item_volume_unit_of_measure",
-            "Specific Uses For Product",
-            "Country/Region of Origin",
-            "Country/Region of Origin",
-            "Legal Disclaimer",
-            "USDA Hardiness Zone",
-            "USDA Hardiness Zone",
-            "Batteries are Included",
-            "Item Weight",
-            "Is this product a battery or does it utilize batteries?",
-            "Battery type/size",
-            "Battery type/size",
-            "Battery type/size",
-            "item_weight_unit_of_measure",
-            "Number of batteries",
-            "Number of batteries",
-            "Number of batteries",
-            "Watt hours per battery",
-            "Lithium Battery Packaging",
-            "Lithium content (grams)",
-            "Number of Lithium-ion Cells",
-            "Number of Lithium Metal Cells",
-            "Battery composition",
-            "Battery weight (grams)",
-            "battery_weight_unit_of_measure",
-            "lithium_battery_energy_content_unit_of_measure",
-            "lithium_battery_weight_unit_of_measure",
-            "Applicable Dangerous Goods Regulations",
-            "Applicable Dangerous Goods Regulations",
-            "Applicable Dangerous Goods Regulations",
-            "Applicable Dangerous Goods Regulations",
-            "Applicable Dangerous Goods Regulations",
-            "UN number",
-            "Safety Data Sheet (SDS) URL",
-            "Lighting Facts Label",
-            "Flash point (°C)?",
-            "external_testing_certification1",
-            "external_testing_certification2",
-            "external_testing_certification3",
-            "external_testing_certification4",
-            "external_testing_certification5",
-            "external_testing_certification6",
-            "Categorization/GHS pictograms (select all that apply)",
-            "Categorization/GHS pictograms (select all that apply)",
-            "Categorization/GHS pictograms (select all that apply)",
-            "California Proposition 65 Warning Type",
-            "California Proposition 65 Chemical Names",
-            "Additional Chemical Name1",
-            "Additional Chemical Name2",
-            "Additional Chemical Name3",
-            "Additional Chemical Name4",
-            "Shipping-Template",
-            "Manufacturer's Suggested Retail Price",
-            "Minimum Advertised Price",
-            "Launch Date",
-            "Release Date",
-            "Item Condition",
-            "Restock Date",
-            "Handling Time",
-            "Offer Condition Note",
-            "Product Tax Code",
-            "Sale Price",
-            "Sale Start Date",
-            "Sale End Date",
-            "Package Quantity",
-            "Max Aggregate Ship Quantity",
-            "Offering Can Be Gift Messaged",
-            "Is Gift Wrap Available",
-            "Is Discontinued by Manufacturer",
-            "Max Order Quantity",
-            "Number of Items",
-            "Offering Release Date",
-            "Stop Selling Date"
-        ]
-    ]
     now_str = datetime.now().strftime("%Y%m%d%H%M")
-    keys = formatted_dicts[0].keys()
-    with open(f"amazon_data_{now_str}.txt", "w", newline="") as output_file:
-        writer = csv.writer(output_file, delimiter="\t")
-        writer.writerows(amazon_data)
-        dict_writer = csv.DictWriter(output_file, keys, delimiter="\t")
-        dict_writer.writeheader()
-        dict_writer.writerows(formatted_dicts)
+    print("Write listing information to txt file")
+    listed = amazon_listing.write_listing_files(
+        listing_rows(), f"amazon_data_{now_str}", max_rows)
+    for slogan_dict in listed:
+        if on_listed is not None:
+            on_listed(slogan_dict)
+
+
+def profile_pipeline(input_file, render_options, upload_options, output_dir,
+                     rows=20, fit="rewrap"):
+    # Profiles the first `rows` valid rows of `input_file` through
+    # `render_mugs` and `upload_mugs_to_s3`, in this process, writing the
+    # reports of each stage to `output_dir`.  The renders really are
+    # uploaded, but not journaled or listed.
+    with open(input_file, encoding="utf-8-sig") as csv_file:
+        valid_slogans = list(islice(
+            validate_slogans(csv.DictReader(csv_file), fit), rows))
+    # cProfile only sees this process
+    render_options = dict(render_options, workers=1)
+    with profiling.profile_stage("render", output_dir):
+        rendered_slogans = render_mugs(valid_slogans, **render_options)
+    with profiling.profile_stage("upload", output_dir):
+        upload_mugs_to_s3(rendered_slogans, **upload_options)
+    print(f"Profile of {len(valid_slogans)} rows written to {output_dir}")
+
+
+def run_pipeline(input_file, render_options, upload_options, save_renders=False,
+                 fit="rewrap", journal_path=None, resume=False,
+                 listing_max_rows=amazon_listing.DEFAULT_MAX_ROWS):
+    # Rows flow from the CSV through validation, rendering, upload and the
+    # listing file one at a time.  Each stage only pulls from the one before
+    # when it has room, so uploads start with the first render and nothing
+    # holds the whole batch.  Every row's progress goes to the job journal;
+    # with `resume`, rows an earlier run got through are skipped.
+    print("Validate, render and upload slogans")
+    journal_path = journal_path or journal.journal_path(input_file)
+    entries, journal_file = journal.open_journal(journal_path, resume)
+    with open(input_file, encoding="utf-8-sig") as csv_file, journal_file:
+        valid_slogans = journal.resume_slogans(
+            entries, validate_slogans(csv.DictReader(csv_file), fit), get_views())
+        # PNGs are encoded in memory and handed straight to the uploader,
+        # unless they are saved to render/ for debugging
+        rendered = skip_failed(render_slogans(
+            valid_slogans, in_memory=not save_renders, **render_options))
+        rendered = journal.record_stage(journal_file, rendered, "rendered")
+        uploaded = skip_failed(upload_slogans(rendered, **upload_options))
+        uploaded = journal.record_stage(
+            journal_file, uploaded, "uploaded", get_views())
+        create_amazon_upload_file(
+            uploaded,
+            first_sku=journal.count_listed(entries),
+            on_listed=lambda slogan: journal.record(journal_file, slogan, "listed"),
+            max_rows=listing_max_rows)
+        if not save_renders:
+            rmtree(RENDER_PATH, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -1023,16 +1176,229 @@ if __name__ == "__main__":
         default="input.csv",
         help="Path to CSV with slogans and niches."
     )
+    p.add_argument(
+        "--registry",
+        default=None,
+        help="Path to the JSON registry of fonts, canvases and templates."
+    )
+    p.add_argument(
+        "--fit",
+        choices=["rewrap", "reject", "off"],
+        default="rewrap",
+        help="Rewrap or reject slogans whose lines would be clipped on the canvas."
+    )
+    p.add_argument(
+        "--legacy_warp",
+        action="store_true",
+        help="Use the per-pixel reference warp instead of the NumPy one."
+    )
+    p.add_argument(
+        "--supersample",
+        type=int,
+        choices=SUPERSAMPLE_FACTORS,
+        default=None,
+        help="Draw and warp slogans at this many times the final width instead "
+             "of the font's canvas, e.g. 1 for quick previews."
+    )
+    p.add_argument(
+        "--templated",
+        action="store_true",
+        help="For catalogues of a few slogan patterns with the niche filled in: "
+             "render the part without the niche once per pattern."
+    )
+    p.add_argument(
+        "--encoder_profile",
+        type=encoders.parse_profile_arg,
+        action="append",
+        default=[],
+        help=f"Format of the renders, PROFILE for all views or VIEW=PROFILE, "
+             f"with the views named in the registry. Profiles: "
+             f"{', '.join(encoders.PROFILES)}. Default {encoders.DEFAULT_PROFILE}."
+    )
+    p.add_argument(
+        "--warp_cache_dir",
+        default=None,
+        help="Directory to persist warp maps in, so new runs start warm."
+    )
+    p.add_argument(
+        "--render_cache_dir",
+        default=str(render_cache.DEFAULT_CACHE_PATH),
+        help="Directory of cached renders, reused for unchanged slogans."
+    )
+    p.add_argument(
+        "--render_cache_max_mb",
+        type=int,
+        default=render_cache.DEFAULT_MAX_MB,
+        help="Size of the render cache before least recently used renders go."
+    )
+    p.add_argument(
+        "--no_cache",
+        "--no-cache",
+        action="store_true",
+        help="Render every slogan from scratch and don't touch the render cache."
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to render mugs with."
+    )
+    p.add_argument(
+        "--upload_concurrency",
+        type=int,
+        default=s3_upload.DEFAULT_CONCURRENCY,
+        help="Number of images to upload to S3 at once."
+    )
+    p.add_argument(
+        "--s3_endpoint_url",
+        default=os.environ.get("S3_ENDPOINT_URL"),
+        help="S3 endpoint to upload to instead of AWS, e.g. a local MinIO."
+    )
+    p.add_argument(
+        "--skip_unchanged",
+        action="store_true",
+        help="Don't upload images the bucket already has, going by their "
+             "checksums."
+    )
+    p.add_argument(
+        "--content_keys",
+        action="store_true",
+        help="Name the uploads after their content instead of today's date, so "
+             "unchanged images are reused across days.  Implies --skip_unchanged."
+    )
+    p.add_argument(
+        "--upload_manifest",
+        default=s3_upload.DEFAULT_MANIFEST_PATH,
+        help="Where --skip_unchanged records the checksums of what it uploaded."
+    )
+    p.add_argument(
+        "--save_renders",
+        action="store_true",
+        help="Save the renders to render/ and keep them, for debugging."
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the rows the last run over this input got through, "
+             "according to its job journal."
+    )
+    p.add_argument(
+        "--journal",
+        default=None,
+        help=f"Job journal to record progress in. Default "
+             f"{journal.DEFAULT_JOURNAL_DIR}/<input file name>.jsonl."
+    )
+    p.add_argument(
+        "--listing_max_rows",
+        type=amazon_listing.parse_max_rows_arg,
+        default=amazon_listing.DEFAULT_MAX_ROWS,
+        help="Start a new Amazon listing file after this many rows."
+    )
+    p.add_argument(
+        "--timings",
+        action="store_true",
+        help="Time every stage of every row and print a summary at the end."
+    )
+    p.add_argument(
+        "--timings_export",
+        default=None,
+        help="Also write the timing summary here: Prometheus text for a .prom "
+             "file, e.g. for node_exporter's textfile collector, JSON otherwise.  "
+             "Implies --timings."
+    )
+    p.add_argument(
+        "--profile",
+        default=None,
+        metavar="DIR",
+        help="Profile the first --profile_rows rows through render and upload "
+             "instead of running the batch, and write the reports to DIR."
+    )
+    p.add_argument(
+        "--profile_rows",
+        type=int,
+        default=20,
+        help="Number of rows --profile runs."
+    )
+    p.add_argument(
+        "--batch",
+        action="store_true",
+        help="Run validation, render, upload and listing one after the other."
+    )
 
     args = p.parse_args(sys.argv[1:])
 
+    if args.registry:
+        load_registry(args.registry)
+    for problem in check_registry():
+        print(problem)
+        logging.error(problem)
+    try:
+        encoder_profiles = encoders.get_view_profiles(
+            get_views(), args.encoder_profile)
+    except ValueError as e:
+        p.error(str(e))
+
+    render_options = {
+        "legacy_warp": args.legacy_warp,
+        "warp_cache_dir": args.warp_cache_dir,
+        "workers": args.workers,
+        "render_cache_dir": None if args.no_cache else args.render_cache_dir,
+        "render_cache_max_mb": args.render_cache_max_mb,
+        "supersample": args.supersample,
+        "encoder_profiles": encoder_profiles,
+        "templated": args.templated
+    }
+    upload_options = {
+        "concurrency": args.upload_concurrency,
+        "endpoint_url": args.s3_endpoint_url,
+        "encoder_profiles": encoder_profiles,
+        "manifest_path": (
+            args.upload_manifest if args.skip_unchanged or args.content_keys
+            else None),
+        "content_keys": args.content_keys
+    }
+
+    timings.enable(args.timings or bool(args.timings_export))
+    start_time = time.perf_counter()
+
     input_file = args.input_file
-    with open(input_file, encoding="utf-8-sig") as csv_file:
-        reader = csv.DictReader(csv_file)
-        slogan_dicts = [row for row in reader]
+    if args.profile:
+        profile_pipeline(
+            input_file, render_options, upload_options, args.profile,
+            args.profile_rows, args.fit)
+        sys.exit(0)
 
     Path("finished").mkdir(parents=True, exist_ok=True)
-    valid_slogans = validate_input(slogan_dicts)
-    rendered_slogan_dicts = render_mugs(valid_slogans)
-    uploaded_mugs = upload_mugs_to_s3(rendered_slogan_dicts)
-    create_amazon_upload_file(uploaded_mugs)
+    journal_path = args.journal or journal.journal_path(input_file)
+    if args.batch:
+        entries, journal_file = journal.open_journal(journal_path, args.resume)
+        with open(input_file, encoding="utf-8-sig") as csv_file:
+            reader = csv.DictReader(csv_file)
+            valid_slogans = validate_input(reader, args.fit)
+        valid_slogans = list(
+            journal.resume_slogans(entries, valid_slogans, get_views()))
+
+        with journal_file:
+            rendered_slogan_dicts = list(journal.record_stage(
+                journal_file, render_mugs(valid_slogans, **render_options),
+                "rendered"))
+            uploaded_mugs = list(journal.record_stage(
+                journal_file,
+                upload_mugs_to_s3(rendered_slogan_dicts, **upload_options),
+                "uploaded", get_views()))
+            create_amazon_upload_file(
+                uploaded_mugs,
+                first_sku=journal.count_listed(entries),
+                on_listed=lambda slogan: journal.record(
+                    journal_file, slogan, "listed"),
+                max_rows=args.listing_max_rows)
+    else:
+        run_pipeline(
+            input_file, render_options, upload_options, args.save_renders, args.fit,
+            journal_path, args.resume, args.listing_max_rows)
+
+    if timings.is_enabled():
+        summary = timings.summarize(time.perf_counter() - start_time)
+        print(timings.format_summary(summary))
+        if args.timings_export:
+            timings.export_summary(summary, args.timings_export)
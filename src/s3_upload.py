@@ -0,0 +1,190 @@
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import threading
+import timings
+
+BUCKET = "giftsondemand"
+DEFAULT_CONCURRENCY = 16
+# Retries use botocore's adaptive mode: exponential backoff plus client-side
+# rate limiting once S3 starts throttling (SlowDown, 503s)
+MAX_ATTEMPTS = 8
+
+# Mug renders are a few MB and go up in one PUT; anything bigger is split
+# into parts.  Concurrency comes from uploading many files at once, so a
+# single transfer doesn't start threads of its own.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=False
+)
+
+DEFAULT_MANIFEST_PATH = Path(".mugup_cache/uploads.jsonl")
+# Content-hashed keys live under this prefix rather than a date
+CONTENT_KEY_PREFIX = "sha256"
+
+# What this machine knows to be in the buckets, to skip re-uploading
+# unchanged images.  `entries` maps (endpoint, bucket, key) to the MD5 of
+# the object's bytes; `file` is the manifest it's appended to and `counts`
+# tallies "uploaded" and "skipped".  Shared by the upload threads, hence
+# `lock`.
+UploadManifest = namedtuple("UploadManifest", ["entries", "file", "lock", "counts"])
+
+
+def make_s3_client(concurrency=DEFAULT_CONCURRENCY, endpoint_url=None):
+    # One client, and one connection pool, shared by all upload threads.
+    # `endpoint_url` points the uploads at a local stand-in such as MinIO.
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID", ""),
+        aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=concurrency,
+            retries={"max_attempts": MAX_ATTEMPTS, "mode": "adaptive"}
+        )
+    )
+
+
+def object_url(bucket, key, endpoint_url=None):
+    if endpoint_url:
+        return f"{endpoint_url.rstrip('/')}/{bucket}/{key}"
+    # Example finished AWS S3 URL
+    # https://giftsondemand.s3.amazonaws.com/2020-01-07/10_r.png
+    return f"https://{bucket}.s3.amazonaws.com/{key}"
+
+
+def content_key(source, extension):
+    # Key named after the image's content, the same whatever day it's
+    # uploaded on
+    data = source if isinstance(source, bytes) else Path(source).read_bytes()
+    return f"{CONTENT_KEY_PREFIX}/{hashlib.sha256(data).hexdigest()}.{extension}"
+
+
+def open_upload_manifest(path=DEFAULT_MANIFEST_PATH):
+    # Loads the manifest, ignoring a torn last line, and opens it for
+    # appending
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    entries = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[(entry["endpoint"], entry["bucket"], entry["key"])] = \
+                    entry["md5"]
+    except FileNotFoundError:
+        pass
+    return UploadManifest(entries, open(path, "a"), threading.Lock(), Counter())
+
+
+def record_upload(manifest, s3, bucket, key, md5):
+    entry = {"endpoint": s3.meta.endpoint_url, "bucket": bucket, "key": key, "md5": md5}
+    with manifest.lock:
+        manifest.entries[(entry["endpoint"], bucket, key)] = md5
+        manifest.file.write(json.dumps(entry) + "\n")
+        manifest.file.flush()
+
+
+def list_checksums(s3, bucket, prefix, manifest):
+    # Adds the checksums of everything under `prefix` to `manifest`, in
+    # pages of a thousand rather than a HEAD per image.  A single-part
+    # upload's ETag is the MD5 of its bytes; a multipart one's isn't, and
+    # won't match, leaving those to `object_unchanged`.
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            manifest.entries[(s3.meta.endpoint_url, bucket, obj["Key"])] = \
+                obj["ETag"].strip('"')
+
+
+def object_unchanged(s3, bucket, key, md5, manifest):
+    # Whether the bucket already has bytes with this MD5 under `key`.  The
+    # manifest is trusted; delete it after removing objects by hand.
+    if manifest.entries.get((s3.meta.endpoint_url, bucket, key)) == md5:
+        return True
+    try:
+        head = s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    if md5 in (head["ETag"].strip('"'), head.get("Metadata", {}).get("md5")):
+        record_upload(manifest, s3, bucket, key, md5)
+        return True
+    return False
+
+
+def upload_file(s3, bucket, key, source, content_type="image/png", manifest=None):
+    # `source` is a local path or the file's bytes.  With `manifest`, the
+    # upload is skipped when the bucket already has the same bytes under
+    # `key`.
+    extra_args = {"ContentType": content_type, "ACL": "public-read"}
+    if manifest is not None:
+        if not isinstance(source, bytes):
+            source = Path(source).read_bytes()
+        md5 = hashlib.md5(source).hexdigest()
+        if object_unchanged(s3, bucket, key, md5, manifest):
+            with manifest.lock:
+                manifest.counts["skipped"] += 1
+            return
+        # Multipart ETags aren't an MD5, so keep it alongside for HEADs
+        extra_args["Metadata"] = {"md5": md5}
+    if isinstance(source, bytes):
+        f = BytesIO(source)
+    else:
+        f = open(source, "rb")
+    with f, timings.span("upload"):
+        s3.upload_fileobj(f, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+    if manifest is not None:
+        record_upload(manifest, s3, bucket, key, md5)
+        with manifest.lock:
+            manifest.counts["uploaded"] += 1
+
+
+def _group_done(group):
+    return all(future.done() for future in group[1])
+
+
+def _finish_group(group):
+    # Waits for the group's uploads; returns its tag and first error
+    tag, futures = group
+    errors = [future.exception() for future in futures]
+    return tag, next((error for error in errors if error), None)
+
+
+def upload_groups(s3, bucket, groups, concurrency=DEFAULT_CONCURRENCY,
+                  max_pending=None, manifest=None):
+    # groups [(tag, [(key, local path or bytes, content type), ...])], e.g.
+    # the four images of one slogan.  Uploads run `concurrency` at a time;
+    # yields (tag, error) per group in input order, error being None on
+    # success.  At most
+    # `max_pending` groups are in flight, so a slow bucket holds back
+    # whatever feeds `groups`.  With `manifest`, unchanged images are
+    # skipped, see `upload_file`.
+    max_pending = max_pending or concurrency * 2
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for tag, uploads in groups:
+            futures = [
+                executor.submit(
+                    upload_file, s3, bucket, key, source, content_type, manifest)
+                for key, source, content_type in uploads
+            ]
+            pending.append((tag, futures))
+            while pending and (len(pending) >= max_pending
+                               or _group_done(pending[0])):
+                yield _finish_group(pending.popleft())
+        while pending:
+            yield _finish_group(pending.popleft())
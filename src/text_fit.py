@@ -0,0 +1,66 @@
+from assets import get_font, get_font_spec
+from functools import lru_cache
+import string
+
+# Advance widths ignore kerning and glyph overhang, which move a line's real
+# width by up to ~80px in our fonts; keep that much of the canvas spare
+WIDTH_SLACK = 0.93
+
+# draw_slogan centres the text block, then moves it up this far
+TEXT_OFFSET = 60
+
+
+@lru_cache(maxsize=None)
+def advance_table(font_name):
+    # char -> advance width in px at the font's render size.  Filled for
+    # printable ASCII up front and for anything else as it turns up.
+    font = get_font(font_name)
+    return {char: font.getlength(char) for char in string.printable}
+
+
+@lru_cache(maxsize=None)
+def line_height(font_name):
+    # Tallest a line can be; lines without ascenders/descenders are shorter
+    ascent, descent = get_font(font_name).getmetrics()
+    return ascent + descent
+
+
+def line_width(font_name, line):
+    table = advance_table(font_name)
+    width = 0
+    for char in line:
+        advance = table.get(char)
+        if advance is None:
+            advance = table[char] = get_font(font_name).getlength(char)
+        width += advance
+    return width
+
+
+def check_fit(font_name, lines):
+    # Returns why `lines` would be clipped on the font's canvas, or None
+    canvas_w, canvas_h = get_font_spec(font_name)["canvas"]
+    max_width = canvas_w * WIDTH_SLACK
+    for line in lines:
+        width = line_width(font_name, line)
+        if width > max_width:
+            return f"Line \"{line}\" is too wide ({int(width)}px, max {int(max_width)}px).  Make the slogan shorter"  # noqa:E501
+
+    text_h = len(lines) * line_height(font_name)
+    top = (canvas_h - text_h) / 2 - TEXT_OFFSET
+    if top < 0 or top + text_h > canvas_h:
+        return f"Text is too tall ({text_h}px, max {canvas_h - 2 * TEXT_OFFSET}px).  Make the slogan shorter"  # noqa:E501
+    return None
+
+
+def fit_wrap(font_name, text):
+    # Greedy wrap by measured width instead of character count.  A word too
+    # wide for the canvas gets a line of its own; `check_fit` rejects it.
+    canvas_w = get_font_spec(font_name)["canvas"][0]
+    max_width = canvas_w * WIDTH_SLACK
+    lines = []
+    for word in text.split():
+        if lines and line_width(font_name, f"{lines[-1]} {word}") <= max_width:
+            lines[-1] = f"{lines[-1]} {word}"
+        else:
+            lines.append(word)
+    return lines
@@ -0,0 +1,141 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import json
+import numpy as np
+import os
+from pathlib import Path
+import time
+
+# In pipeline order, for the summary
+STAGES = (
+    "validate", "draw", "warp", "resize", "composite", "encode", "upload", "listing")
+QUANTILES = (0.5, 0.95, 0.99)
+
+_enabled = False
+# Stage -> seconds, one sample per span.  Upload threads append too, which
+# list.append makes safe.
+_samples = defaultdict(list)
+_no_span = nullcontext()
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def _timed_span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _samples[stage].append(time.perf_counter() - start)
+
+
+def span(stage):
+    # Times the `with` block as a sample of `stage`.  When timing is off
+    # this returns one shared no-op context, so spans cost next to nothing.
+    if not _enabled:
+        return _no_span
+    return _timed_span(stage)
+
+
+def take_samples():
+    # Hands over this process's samples, e.g. from a render worker to the
+    # main process, and starts afresh
+    samples = dict(_samples)
+    _samples.clear()
+    return samples
+
+
+def add_samples(samples):
+    for stage, seconds in samples.items():
+        _samples[stage].extend(seconds)
+
+
+def summarize(wall_seconds):
+    # Per stage: sample count, total seconds, quantiles and items per second
+    # of busy time.  Workers and upload threads overlap, so the run as a
+    # whole goes faster than the slowest stage's items per second.  The
+    # rows are the ones that made it into the listing.
+    rows = len(_samples.get("listing", []))
+    stages = {}
+    order = {stage: i for i, stage in enumerate(STAGES)}
+    for stage in sorted(_samples, key=lambda s: order.get(s, len(STAGES))):
+        seconds = np.array(_samples[stage])
+        if not seconds.size:
+            continue
+        total = float(seconds.sum())
+        stages[stage] = {
+            "count": int(seconds.size),
+            "total_seconds": total,
+            "quantiles": {
+                str(q): float(np.percentile(seconds, q * 100)) for q in QUANTILES},
+            "items_per_second": seconds.size / total if total else None
+        }
+    return {
+        "wall_seconds": wall_seconds,
+        "rows": rows,
+        "rows_per_second": rows / wall_seconds if wall_seconds else None,
+        "stages": stages
+    }
+
+
+def format_summary(summary):
+    lines = [
+        f"{'stage':<10} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+        f"{'p99 ms':>9} {'items/s':>9}"
+    ]
+    for stage, stats in summary["stages"].items():
+        p50, p95, p99 = (stats["quantiles"][str(q)] * 1000 for q in QUANTILES)
+        items_per_second = stats["items_per_second"] or 0
+        lines.append(
+            f"{stage:<10} {stats['count']:>7} {stats['total_seconds']:>9.2f} "
+            f"{p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {items_per_second:>9.1f}")
+    rows_per_second = summary["rows_per_second"] or 0
+    lines.append(
+        f"{summary['rows']} rows in {summary['wall_seconds']:.1f}s, "
+        f"{rows_per_second:.2f} rows/s")
+    return "\n".join(lines)
+
+
+def format_prometheus(summary):
+    # Prometheus text format, for node_exporter's textfile collector
+    lines = [
+        "# HELP mugup_stage_seconds Seconds per item spent in a pipeline stage.",
+        "# TYPE mugup_stage_seconds summary"
+    ]
+    for stage, stats in summary["stages"].items():
+        for q, seconds in stats["quantiles"].items():
+            lines.append(
+                f'mugup_stage_seconds{{stage="{stage}",quantile="{q}"}} {seconds}')
+        lines.append(
+            f'mugup_stage_seconds_sum{{stage="{stage}"}} {stats["total_seconds"]}')
+        lines.append(f'mugup_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    lines += [
+        "# HELP mugup_run_seconds Wall time of the last run.",
+        "# TYPE mugup_run_seconds gauge",
+        f"mugup_run_seconds {summary['wall_seconds']}",
+        "# HELP mugup_run_rows Rows listed by the last run.",
+        "# TYPE mugup_run_rows gauge",
+        f"mugup_run_rows {summary['rows']}"
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def export_summary(summary, path):
+    # Prometheus text for a .prom path, JSON otherwise.  Written then
+    # renamed, so a collector never reads half a file.
+    path = Path(path)
+    if path.suffix == ".prom":
+        text = format_prometheus(summary)
+    else:
+        text = json.dumps(summary, indent=2) + "\n"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,271 @@
+from collections import OrderedDict, namedtuple
+import logging
+from math import ceil
+import numpy as np
+import os
+from pathlib import Path
+from PIL import Image
+
+DEFLECTION = 0.075
+
+# Everything the warp needs that depends only on the canvas size and the
+# deflection. `rows[y, x]` is the destination row of source pixel (x, y),
+# or -1 when it falls outside the new canvas; `alpha[x]` is the opacity of
+# column x.
+WarpMap = namedtuple("WarpMap", ["new_height", "rows", "alpha"])
+
+# (width, height, deflection) -> WarpMap, shared by every render in the process
+_warp_maps = {}
+
+# Warped regions that recur, see `transform_shared_region`: key -> (image,
+# source top, warped top), least recently used first
+SHARED_REGION_CACHE_SIZE = 16
+_shared_regions = OrderedDict()
+
+
+def solve_quadratic_coeffs(point_1, point_2, point_3):
+    points = np.array([point_1, point_2, point_3])
+    x = points[:, 0]
+    y = points[:, 1]
+    z = np.polyfit(x, y, 2)
+    return z
+
+
+def plot_deflected_point(x, a, b, height):
+    return int(a * x ** 2 + b * x + height)
+
+
+def plot_alpha_point(x, d, e, f):
+    return d * x ** 2 + e * x + f
+
+
+def _pack_rgba(r, g, b, a):
+    return np.array([r, g, b, a], dtype=np.uint8).view(np.uint32)[0]
+
+
+def fit_warp_curves(original_w, original_h, deflection=DEFLECTION):
+    # Quadratic for deflection found by fitting 3 points
+    mid_x = original_w / 2
+    mid_y = original_h * deflection
+
+    # Deflection eqn coeffs
+    a, b, c = solve_quadratic_coeffs(
+        point_1=(0, 0),
+        point_2=(mid_x, mid_y),
+        point_3=(original_w, 0)
+    )
+
+    # Alpha (opacity) eqn found by fitting 3 points
+    d, e, f = solve_quadratic_coeffs(
+        point_1=(0, 0.8),
+        point_2=(original_w / 4, 0.9),
+        point_3=(mid_x, 0.95)
+    )
+
+    return (a, b), (d, e, f)
+
+
+def transform_slogan_legacy(original_img, deflection=DEFLECTION):
+    # Per-pixel reference implementation.  Kept so the output of
+    # `transform_region` can be diffed against it (`--legacy_warp`).
+    original_pixel = original_img.load()
+
+    # The new image will be tallest on the bottom and in
+    # the middle of the line.  So new height should be the
+    # original height plus the new y value at the bottom of
+    # the old image.
+    original_w = original_img.size[0]
+    original_h = original_img.size[1]
+    mid_x = original_w / 2
+
+    (a, b), (d, e, f) = fit_warp_curves(original_w, original_h, deflection)
+    new_h = int(ceil(plot_deflected_point(mid_x, a, b, original_h)))
+    new_img = Image.new("RGBA", (original_w, new_h), (255, 255, 255, 0))
+
+    for x in range(original_w):  # cols
+        if x < mid_x:
+            alpha_value = int(ceil(plot_alpha_point(x, d, e, f) * 255))
+        else:
+            reflected_x = 2 * mid_x - x
+            alpha_value = int(ceil(plot_alpha_point(reflected_x, d, e, f) * 255))
+        for y in range(original_h):  # rows
+            current_pixel = original_pixel[x, y]
+            if current_pixel != (255, 255, 255, 0) and current_pixel != (0, 0, 0, 0):  # noqa:E501
+                new_pixel = (current_pixel[0], current_pixel[1],
+                             current_pixel[2], alpha_value)
+                new_pixel_y = plot_deflected_point(x, a, b, y)
+                try:
+                    new_img.putpixel((x, new_pixel_y), new_pixel)
+                except Exception as e:
+                    logging.error(e)
+                    continue
+
+    return new_img
+
+
+def build_warp_map(original_w, original_h, deflection=DEFLECTION):
+    # The curves are evaluated with the same float64 arithmetic, in the same
+    # order, as the per-pixel loop in `transform_slogan_legacy`.
+    mid_x = original_w / 2
+    (a, b), (d, e, f) = fit_warp_curves(original_w, original_h, deflection)
+    new_h = int(ceil(plot_deflected_point(mid_x, a, b, original_h)))
+
+    cols = np.arange(original_w, dtype=np.float64)
+    reflected_cols = np.where(cols < mid_x, cols, 2 * mid_x - cols)
+    alpha = np.ceil(plot_alpha_point(reflected_cols, d, e, f) * 255)
+    alpha = alpha.astype(np.uint8)
+
+    col_offsets = a * cols ** 2 + b * cols
+    src_rows = np.arange(original_h, dtype=np.float64)[:, None]
+    rows = (col_offsets + src_rows).astype(np.int64)
+    rows[(rows < 0) | (rows >= new_h)] = -1
+    rows_dtype = np.int16 if new_h <= np.iinfo(np.int16).max else np.int32
+
+    return WarpMap(new_h, rows.astype(rows_dtype), alpha)
+
+
+def _warp_map_paths(cache_dir, original_w, original_h, deflection):
+    stem = f"warp_{original_w}x{original_h}_{deflection}"
+    return (
+        Path(cache_dir) / f"{stem}_rows.npy",
+        Path(cache_dir) / f"{stem}_alpha.npy"
+    )
+
+
+def _save_array(path, array):
+    # Write then rename so concurrent renders never read a partial file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def get_warp_map(original_w, original_h, deflection=DEFLECTION, cache_dir=None):
+    key = (original_w, original_h, deflection)
+    if key in _warp_maps:
+        return _warp_maps[key]
+
+    warp_map = None
+    if cache_dir is not None:
+        rows_path, alpha_path = _warp_map_paths(cache_dir, *key)
+        try:
+            mid_x = original_w / 2
+            (a, b), _ = fit_warp_curves(original_w, original_h, deflection)
+            warp_map = WarpMap(
+                int(ceil(plot_deflected_point(mid_x, a, b, original_h))),
+                np.load(rows_path, mmap_mode="r"),
+                np.load(alpha_path)
+            )
+        except (OSError, ValueError):
+            warp_map = None
+
+    if warp_map is None:
+        warp_map = build_warp_map(*key)
+        if cache_dir is not None:
+            try:
+                Path(cache_dir).mkdir(parents=True, exist_ok=True)
+                _save_array(rows_path, warp_map.rows)
+                _save_array(alpha_path, warp_map.alpha)
+            except OSError as e:
+                logging.error(f"Could not persist warp map: {e}")
+
+    _warp_maps[key] = warp_map
+    return warp_map
+
+
+def transform_region(region_img, left, top, canvas_size, deflection=DEFLECTION,
+                     cache_dir=None):
+    # Warps the part of a `canvas_size` slogan image that starts at
+    # (`left`, `top`), e.g. the box around the text.  Returns the warped
+    # pixels cropped to the rows they land on, and the top of that crop in
+    # the full warped image; columns don't move, so it still starts at
+    # `left`.  Pixels outside the region must be transparent.  A pixel
+    # deflected outside the warped canvas is dropped silently rather than
+    # logged as the legacy `putpixel` loop does.
+    if region_img.mode != "RGBA":
+        region_img = region_img.convert("RGBA")
+    region = np.asarray(region_img)
+    region_w = region.shape[1]
+    warp_map = get_warp_map(*canvas_size, deflection, cache_dir)
+
+    # Fully transparent pixels are skipped, as in the legacy loop.  Compare
+    # whole pixels as packed uint32 rather than channel by channel.
+    packed = np.ascontiguousarray(region).view(np.uint32)[..., 0]
+    transparent = (packed == _pack_rgba(255, 255, 255, 0)) | (packed == 0)
+    # Column-major order so a later row wins when two rows of one column
+    # truncate to the same destination, exactly like repeated `putpixel`.
+    xs, ys = np.nonzero(~transparent.T)
+    new_ys = warp_map.rows[ys + top, xs + left]
+
+    keep = new_ys >= 0
+    keep[:-1] &= (xs[:-1] != xs[1:]) | (new_ys[:-1] != new_ys[1:])
+    xs, ys, new_ys = xs[keep], ys[keep], new_ys[keep]
+
+    new_top = int(new_ys.min()) if new_ys.size else 0
+    new_h = int(new_ys.max()) + 1 - new_top if new_ys.size else 1
+    new_ys = new_ys - new_top
+
+    new = np.full((new_h, region_w), _pack_rgba(255, 255, 255, 0), np.uint32)
+    new = new.view(np.uint8).reshape(new_h, region_w, 4)
+    new[new_ys, xs, :3] = region[ys, xs, :3]
+    new[new_ys, xs, 3] = warp_map.alpha[xs + left]
+
+    return Image.fromarray(new, "RGBA"), new_top
+
+
+def clear_shared_regions():
+    _shared_regions.clear()
+
+
+def transform_shared_region(key, make_region, left, top, region_size, canvas_size,
+                            deflection=DEFLECTION, cache_dir=None):
+    # `transform_region` for a region that recurs at different heights, e.g.
+    # a line of text many slogans share.  `key` stands for the region's
+    # pixels and `left`; `make_region()` draws them when they aren't cached.
+    # The warp moves every row of a column by the same amount, so a cached
+    # warp is reused wherever the warp map's rows agree up to the shift,
+    # which they don't always do near the canvas edge.  Warps of other
+    # canvases and deflections are kept apart, as views may differ in both.
+    rows = get_warp_map(*canvas_size, deflection, cache_dir).rows
+    region_w, region_h = region_size
+    key = (key, canvas_size, deflection)
+    cached = _shared_regions.get(key)
+    if cached is not None:
+        warped_img, cached_top, cached_warped_top = cached
+        _shared_regions.move_to_end(key)
+        cached_rows = rows[cached_top:cached_top + region_h, left:left + region_w]
+        region_rows = rows[top:top + region_h, left:left + region_w]
+        if np.array_equal(cached_rows - cached_top, region_rows - top):
+            return warped_img, cached_warped_top + top - cached_top
+
+    warped_img, warped_top = transform_region(
+        make_region(), left, top, canvas_size, deflection, cache_dir)
+    _shared_regions[key] = (warped_img, top, warped_top)
+    _shared_regions.move_to_end(key)
+    if len(_shared_regions) > SHARED_REGION_CACHE_SIZE:
+        _shared_regions.popitem(last=False)
+    return warped_img, warped_top
+
+
+def combine_regions(regions):
+    # Puts warped regions [(image, (left, top)), ...] of one canvas together,
+    # later ones on top where they meet, as a later row wins in the warp.
+    # Returns the image of the box around them all and its (left, top).
+    left = min(region_left for _, (region_left, _) in regions)
+    top = min(region_top for _, (_, region_top) in regions)
+    right = max(region_left + img.size[0] for img, (region_left, _) in regions)
+    bottom = max(region_top + img.size[1] for img, (_, region_top) in regions)
+
+    new = np.full(
+        (bottom - top, right - left), _pack_rgba(255, 255, 255, 0), np.uint32)
+    new = new.view(np.uint8).reshape(bottom - top, right - left, 4)
+    for img, (region_left, region_top) in regions:
+        region = np.asarray(img)
+        # Every pixel the warp moves gets its column's opacity, never 0
+        warped = region[..., 3] != 0
+        new_region = new[
+            region_top - top:region_top - top + img.size[1],
+            region_left - left:region_left - left + img.size[0]
+        ]
+        new_region[warped] = region[warped]
+    return Image.fromarray(new, "RGBA"), (left, top)